@@ -0,0 +1,125 @@
+"""Controle de admissão das rotas usadas pelos controladores (ESP32).
+
+Baldes de tokens em memória (por dispositivo, por IP de origem e global) e
+um limite de requisições simultâneas, para que um firmware em loop não ocupe
+todos os workers e deixe a interface web sem resposta.
+"""
+import math
+import threading
+import time
+from collections import OrderedDict
+
+
+class BaldeTokens:
+    """Balde de tokens clássico: `taxa` tokens por segundo, até `rajada` acumulados"""
+
+    def __init__(self, taxa, rajada, agora):
+        self.taxa = taxa
+        self.rajada = rajada
+        self.tokens = float(rajada)
+        self.atualizado = agora
+
+    def consumir(self, agora):
+        """Retorna 0 se consumiu um token, senão os segundos até haver um disponível"""
+        self.tokens = min(self.rajada, self.tokens + (agora - self.atualizado) * self.taxa)
+        self.atualizado = agora
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.taxa
+
+    def devolver(self):
+        self.tokens = min(self.rajada, self.tokens + 1)
+
+
+class ControleAdmissao:
+    """Decide, antes de qualquer acesso ao banco, se uma requisição de dispositivo entra.
+
+    Não é compartilhado entre processos: cada worker do gunicorn aplica os
+    limites de forma independente.
+    """
+
+    def __init__(self, taxa_dispositivo=1.0, rajada_dispositivo=5, taxa_global=50.0, rajada_global=100,
+                 max_concorrentes=4, max_dispositivos=10000, taxa_origem=10.0, rajada_origem=20,
+                 relogio=time.monotonic):
+        self.taxa_dispositivo = taxa_dispositivo
+        self.rajada_dispositivo = rajada_dispositivo
+        self.taxa_origem = taxa_origem
+        self.rajada_origem = rajada_origem
+        self.max_dispositivos = max_dispositivos
+        self.relogio = relogio
+        self._lock = threading.Lock()
+        self._global = BaldeTokens(taxa_global, rajada_global, relogio())
+        self._dispositivos = OrderedDict()
+        self._origens = OrderedDict()
+        # Orçamento de requisições de dispositivo em andamento: o restante dos
+        # threads do worker fica livre para /login, /dashboard etc.
+        self._vagas = threading.BoundedSemaphore(max_concorrentes)
+        self._contadores = {
+            'admitidas': 0,
+            'rejeitadas_dispositivo': 0,
+            'rejeitadas_origem': 0,
+            'rejeitadas_global': 0,
+            'rejeitadas_concorrencia': 0,
+        }
+
+    def _balde(self, baldes, chave, taxa, rajada, agora):
+        balde = baldes.get(chave)
+        if balde is None:
+            balde = BaldeTokens(taxa, rajada, agora)
+            baldes[chave] = balde
+            # Descarta as chaves mais antigas para limitar a memória
+            while len(baldes) > self.max_dispositivos:
+                baldes.popitem(last=False)
+        else:
+            baldes.move_to_end(chave)
+        return balde
+
+    def admitir(self, dispositivo, origem=None):
+        """Retorna (admitido, retry_after_segundos).
+
+        `origem` (o IP do cliente) tem um balde próprio, mais folgado que o do
+        dispositivo: vários controladores atrás do mesmo NAT cabem nele, mas
+        trocar o identificador a cada requisição não escapa do limite.
+        Quem for admitido deve chamar liberar() ao terminar a requisição.
+        """
+        with self._lock:
+            agora = self.relogio()
+            balde = self._balde(self._dispositivos, dispositivo, self.taxa_dispositivo,
+                                self.rajada_dispositivo, agora)
+            espera = balde.consumir(agora)
+            if espera:
+                self._contadores['rejeitadas_dispositivo'] += 1
+                return False, math.ceil(espera)
+            # Baldes já debitados; se a requisição não for atendida, devolvem o token
+            pagos = [balde]
+            if origem is not None and origem != dispositivo:
+                balde_origem = self._balde(self._origens, origem, self.taxa_origem, self.rajada_origem, agora)
+                espera = balde_origem.consumir(agora)
+                if espera:
+                    balde.devolver()
+                    self._contadores['rejeitadas_origem'] += 1
+                    return False, math.ceil(espera)
+                pagos.append(balde_origem)
+            espera = self._global.consumir(agora)
+            if espera:
+                for b in pagos:
+                    b.devolver()
+                self._contadores['rejeitadas_global'] += 1
+                return False, math.ceil(espera)
+            if not self._vagas.acquire(blocking=False):
+                for b in pagos:
+                    b.devolver()
+                self._global.devolver()
+                self._contadores['rejeitadas_concorrencia'] += 1
+                return False, 1
+            self._contadores['admitidas'] += 1
+            return True, 0
+
+    def liberar(self):
+        self._vagas.release()
+
+    def metricas(self):
+        with self._lock:
+            return dict(self._contadores, dispositivos_rastreados=len(self._dispositivos),
+                        origens_rastreadas=len(self._origens))
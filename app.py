@@ -1,11 +1,26 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for, flash
+from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, Response, stream_with_context, g, send_from_directory
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from flask_bcrypt import Bcrypt
-from datetime import datetime, timedelta
+from werkzeug.middleware.proxy_fix import ProxyFix
+from datetime import datetime, timedelta, date
+from collections import OrderedDict
 import pytz
 import os
+import base64
+import hashlib
+import hmac
+import json
+import threading
+import multiprocessing
 from dotenv import load_dotenv
+from admissao import ControleAdmissao
+from relogio import RelogioSistema
+from tarefas import GerenciadorTarefas, ESTADOS_FINAIS
+from perfil_servidor import perfil_concorrencia, opcoes_engine, iniciar_sonda, estatisticas_pool
+from clima import MotorClima, FontePrevisaoArquivo
+from arquivo_historico import Arquivador, TabelaArquivavel, TEMPO, INTEIRO, REAL, TEXTO
+import click
 import re # Importa o módulo de expressões regulares para validação de hora
 
 # Carregar variáveis de ambiente
@@ -16,6 +31,12 @@ CODIGO_CONVITE = os.environ.get('CODIGO_CONVITE', 'IRRIGACAO2025')
 print(f"🔑 CÓDIGO DE CONVITE CARREGADO: '{CODIGO_CONVITE}'")
 
 app = Flask(__name__)
+# Atrás de um proxy, remote_addr seria sempre o IP do proxy. PROXY_SALTOS é quantos
+# proxies confiáveis há na frente; o padrão 0 não confia em X-Forwarded-For (flask run,
+# app exposto direto), e o gunicorn.conf.py de produção define 1.
+PROXY_SALTOS = int(os.environ.get('PROXY_SALTOS', 0))
+if PROXY_SALTOS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_SALTOS, x_proto=PROXY_SALTOS)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-secret-key-change-in-production')
 
 # Configuração do banco de dados
@@ -31,10 +52,11 @@ else:
     print("🔗 Usando SQLite local")
 
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
-    'pool_pre_ping': True,
-    'pool_recycle': 300,
-}
+# Pool dimensionado pelo perfil de concorrência (ver perfil_servidor.py e gunicorn.conf.py)
+perfil = perfil_concorrencia()
+usa_postgres = app.config['SQLALCHEMY_DATABASE_URI'].startswith('postgresql')
+if usa_postgres:
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = opcoes_engine(perfil)
 
 db = SQLAlchemy(app)
 bcrypt = Bcrypt(app)
@@ -46,9 +68,18 @@ login_manager.login_message_category = 'info'
 # Fuso horário de Brasília
 BRASILIA_TZ = pytz.timezone('America/Sao_Paulo')
 
+# Fonte de tempo de agora_br(); pode ser trocada por um RelogioSimulado
+_relogio = RelogioSistema(BRASILIA_TZ)
+
+def definir_relogio(relogio):
+    """Troca o relógio usado por agora_br() e retorna o anterior"""
+    global _relogio
+    anterior, _relogio = _relogio, relogio
+    return anterior
+
 def agora_br():
     """Retorna o horário atual em Brasília"""
-    return datetime.now(BRASILIA_TZ)
+    return _relogio.agora()
 
 # Modelos do banco de dados
 class Usuario(UserMixin, db.Model):
@@ -74,34 +105,551 @@ class HorarioRega(db.Model):
     criado_em = db.Column(db.DateTime, default=lambda: agora_br())
     usuario_id = db.Column(db.Integer, db.ForeignKey('usuario.id'), nullable=False)
 
+    # Índice que sustenta a paginação por cursor (usuario_id, hora, id)
+    __table_args__ = (
+        db.Index('ix_horario_rega_usuario_hora_id', 'usuario_id', 'hora', 'id'),
+    )
+
+class VersaoHorarios(db.Model):
+    # Incrementada a cada alteração nos horários do usuário; invalida o cache da agenda
+    usuario_id = db.Column(db.Integer, db.ForeignKey('usuario.id'), primary_key=True)
+    versao = db.Column(db.Integer, nullable=False, default=0)
+
+class EventoRega(db.Model):
+    # Histórico de regas disparadas pelo /status (uma linha por dispositivo e minuto)
+    id = db.Column(db.Integer, primary_key=True)
+    dispositivo = db.Column(db.String(64), nullable=False)
+    inicio = db.Column(db.DateTime, nullable=False, index=True) # Brasília, sem fuso
+    duracao = db.Column(db.Integer, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_evento_rega_dispositivo_inicio', 'dispositivo', 'inicio'),
+    )
+
+class LeituraSensor(db.Model):
+    # Leituras enviadas pelos dispositivos (umidade do solo, temperatura...)
+    id = db.Column(db.Integer, primary_key=True)
+    dispositivo = db.Column(db.String(64), nullable=False)
+    sensor = db.Column(db.String(30), nullable=False)
+    valor = db.Column(db.Float)
+    medido_em = db.Column(db.DateTime, nullable=False, index=True) # Brasília, sem fuso
+
+    __table_args__ = (
+        db.Index('ix_leitura_sensor_dispositivo_medido_em', 'dispositivo', 'medido_em'),
+    )
+
+class Tarefa(db.Model):
+    # Fila de tarefas em segundo plano (ver tarefas.py); horários sem fuso, em Brasília
+    id = db.Column(db.Integer, primary_key=True)
+    tipo = db.Column(db.String(50), nullable=False)
+    estado = db.Column(db.String(20), nullable=False, default='pendente', index=True)
+    parametros = db.Column(db.Text) # JSON
+    resultado = db.Column(db.Text) # JSON
+    erro = db.Column(db.Text)
+    progresso = db.Column(db.Float, default=0.0)
+    mensagem = db.Column(db.String(200))
+    tentativas = db.Column(db.Integer, nullable=False, default=0)
+    max_tentativas = db.Column(db.Integer, nullable=False, default=3)
+    cancelar = db.Column(db.Boolean, nullable=False, default=False)
+    usuario_id = db.Column(db.Integer, db.ForeignKey('usuario.id'))
+    criado_em = db.Column(db.DateTime)
+    iniciado_em = db.Column(db.DateTime)
+    concluido_em = db.Column(db.DateTime)
+    atualizado_em = db.Column(db.DateTime)
+    proxima_tentativa_em = db.Column(db.DateTime)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'tipo': self.tipo,
+            'estado': self.estado,
+            'progresso': self.progresso,
+            'mensagem': self.mensagem,
+            'tentativas': self.tentativas,
+            'max_tentativas': self.max_tentativas,
+            'erro': self.erro,
+            'resultado': json.loads(self.resultado) if self.resultado else None,
+            'criado_em': self.criado_em.isoformat() if self.criado_em else None,
+            'concluido_em': self.concluido_em.isoformat() if self.concluido_em else None,
+        }
+
 @login_manager.user_loader
 def load_user(user_id):
     return Usuario.query.get(int(user_id))
 
-# Criar tabelas ANTES de qualquer requisição
-with app.app_context():
+REGEX_HORA = r'^(?:2[0-3]|[01]?[0-9]):(?:[0-5]?[0-9])$'
+DIAS_SEMANA = ['Seg', 'Ter', 'Qua', 'Qui', 'Sex', 'Sab', 'Dom']
+
+def normalizar_hora(hora):
+    """Converte "7:5" em "07:05" para que a ordenação por texto seja cronológica"""
+    horas, minutos = hora.strip().split(':')
+    return f'{int(horas):02d}:{int(minutos):02d}'
+
+def partes_hora(hora):
+    """Retorna (horas, minutos) de "HH:MM", ou None se o valor estiver corrompido"""
     try:
-        db.create_all()
-        print(f"✅ Banco configurado! {agora_br().strftime('%d/%m/%Y %H:%M:%S')}")
-    except Exception as e:
-        print(f"❌ Erro ao configurar banco: {e}")
+        horas, minutos = (int(p) for p in hora.split(':'))
+        return horas, minutos
+    except (ValueError, AttributeError):
+        return None
+
+# Os processos de CPU do worker de tarefas (spawn) importam este módulo de novo:
+# a preparação do banco e a sonda ficam só com o processo principal (worker web ou CLI),
+# senão cada filho repetiria a migração e seguraria uma conexão a mais para a sonda
+# (o nome cobre a importação do __main__ feita pelo spawn antes de parent_process() existir)
+PROCESSO_PRINCIPAL = (multiprocessing.parent_process() is None
+                      and multiprocessing.current_process().name == 'MainProcess')
+
+# Criar tabelas ANTES de qualquer requisição
+if PROCESSO_PRINCIPAL:
+    with app.app_context():
+        try:
+            db.create_all()
+            # create_all não adiciona índices novos a tabelas já existentes
+            for indice in HorarioRega.__table__.indexes:
+                indice.create(db.engine, checkfirst=True)
+            # Horários gravados antes da normalização ("7:5", "9:00") quebram a ordenação por texto
+            for horario in HorarioRega.query.filter(~HorarioRega.hora.like('__:__')).all():
+                if partes_hora(horario.hora) is not None:
+                    horario.hora = normalizar_hora(horario.hora)
+            db.session.commit()
+            print(f"✅ Banco configurado! {agora_br().strftime('%d/%m/%Y %H:%M:%S')}")
+        except Exception as e:
+            print(f"❌ Erro ao configurar banco: {e}")
+        if usa_postgres:
+            iniciar_sonda(db.engine, perfil['intervalo_sonda'])
 
 # Função auxiliar para verificar horários
-def verificar_horario_rega():
-    """Verifica se deve regar agora"""
+def avaliar_horarios(horarios, agora):
+    """Regra de disparo: rega se a ocorrência de hoje de algum horário cai no minuto de `agora`.
+
+    A ocorrência é calculada por localizar_br(), a mesma regra da agenda: no
+    início do horário de verão o horário inexistente dispara uma hora depois,
+    e no fim dele o horário repetido dispara só na primeira passagem.
+    """
+    minuto = agora.replace(second=0, microsecond=0)
+    dia = agora.date()
+    dia_semana = DIAS_SEMANA[dia.weekday()]
+    for horario in horarios:
+        partes = partes_hora(horario.hora)
+        # Filtro barato antes de localizar: a ocorrência só difere do horário
+        # de parede (em +1h) no dia de início do horário de verão
+        if partes not in ((agora.hour, agora.minute), (agora.hour - 1, agora.minute)):
+            continue
+        if dia_semana in horario.dias_semana and localizar_br(dia, *partes) == minuto:
+            return True, horario.duracao
+    return False, 0
+
+def verificar_horario_rega(horarios=None):
+    """Verifica se deve regar agora (`horarios` evita a consulta ao banco nas simulações)"""
     try:
-        agora = agora_br()
-        hora_atual = agora.strftime('%H:%M')
-        dia_semana = ['Seg', 'Ter', 'Qua', 'Qui', 'Sex', 'Sab', 'Dom'][agora.weekday()]
-        horarios = HorarioRega.query.filter_by(ativo=True).all()
-        for horario in horarios:
-            if hora_atual == horario.hora and dia_semana in horario.dias_semana:
-                return True, horario.duracao
-        return False, 0
+        if horarios is None:
+            horarios = HorarioRega.query.filter_by(ativo=True).all()
+        return avaliar_horarios(horarios, agora_br())
     except Exception as e:
         print(f"❌ Erro no verificador: {e}")
         return False, 0
 
+# Paginação por cursor da listagem de horários
+CAMPOS_HORARIO = ('id', 'hora', 'duracao', 'dias_semana', 'ativo')
+LIMITE_PAGINA_PADRAO = 50
+LIMITE_PAGINA_MAXIMO = 200
+
+def codificar_cursor(hora, horario_id):
+    """Gera um cursor opaco a partir da última linha entregue"""
+    bruto = json.dumps([hora, horario_id]).encode('utf-8')
+    return base64.urlsafe_b64encode(bruto).decode('ascii')
+
+def decodificar_cursor(cursor):
+    """Retorna (hora, id) do cursor ou levanta ValueError"""
+    try:
+        hora, horario_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return str(hora), int(horario_id)
+    except Exception:
+        raise ValueError('Cursor inválido.')
+
+def consultar_horarios(usuario_id, limite=LIMITE_PAGINA_PADRAO, cursor=None, campos=CAMPOS_HORARIO,
+                       ativo=None, dia=None, hora_de=None, hora_ate=None):
+    """Busca uma página de horários ordenada por (hora, id).
+
+    Seleciona apenas as colunas pedidas em `campos` (sem hidratar objetos do
+    ORM) e retorna (linhas, proximo_cursor); proximo_cursor é None na última página.
+    """
+    # hora e id sempre entram na consulta porque formam a chave do cursor
+    colunas = [getattr(HorarioRega, c) for c in dict.fromkeys(('id', 'hora') + tuple(campos))]
+    consulta = db.session.query(*colunas).filter(HorarioRega.usuario_id == usuario_id)
+    if ativo is not None:
+        consulta = consulta.filter(HorarioRega.ativo == ativo)
+    if dia:
+        consulta = consulta.filter(HorarioRega.dias_semana.contains(dia))
+    if hora_de:
+        consulta = consulta.filter(HorarioRega.hora >= hora_de)
+    if hora_ate:
+        consulta = consulta.filter(HorarioRega.hora <= hora_ate)
+    if cursor:
+        ultima_hora, ultimo_id = decodificar_cursor(cursor)
+        consulta = consulta.filter(db.or_(
+            HorarioRega.hora > ultima_hora,
+            db.and_(HorarioRega.hora == ultima_hora, HorarioRega.id > ultimo_id),
+        ))
+    # Busca uma linha a mais para saber se existe próxima página
+    linhas = consulta.order_by(HorarioRega.hora, HorarioRega.id).limit(limite + 1).all()
+    proximo_cursor = None
+    if len(linhas) > limite:
+        linhas = linhas[:limite]
+        proximo_cursor = codificar_cursor(linhas[-1].hora, linhas[-1].id)
+    return linhas, proximo_cursor
+
+def parametros_listagem(args, ativo_padrao=None):
+    """Lê limite/cursor/fields/ativo/dia/de/ate da query string e valida"""
+    try:
+        limite = int(args.get('limit', LIMITE_PAGINA_PADRAO))
+    except ValueError:
+        raise ValueError('Parâmetro limit inválido.')
+    if not (1 <= limite <= LIMITE_PAGINA_MAXIMO):
+        raise ValueError(f'Parâmetro limit deve estar entre 1 e {LIMITE_PAGINA_MAXIMO}.')
+
+    campos = CAMPOS_HORARIO
+    if args.get('fields'):
+        campos = tuple(c.strip() for c in args['fields'].split(',') if c.strip())
+        invalidos = [c for c in campos if c not in CAMPOS_HORARIO]
+        if invalidos or not campos:
+            raise ValueError(f"Campos inválidos: {', '.join(invalidos)}. Use: {', '.join(CAMPOS_HORARIO)}.")
+
+    ativo = {'1': True, '0': False, 'todos': None}.get(args.get('ativo'), ativo_padrao)
+
+    dia = args.get('dia')
+    if dia and dia not in DIAS_SEMANA:
+        raise ValueError(f"Dia inválido. Use: {', '.join(DIAS_SEMANA)}.")
+
+    intervalo = {}
+    for nome in ('de', 'ate'):
+        valor = args.get(nome)
+        if valor:
+            if not re.match(REGEX_HORA, valor):
+                raise ValueError(f'Parâmetro {nome} inválido. Use HH:MM.')
+            intervalo[nome] = normalizar_hora(valor)
+
+    cursor = args.get('cursor')
+    if cursor:
+        decodificar_cursor(cursor)
+
+    return {
+        'limite': limite,
+        'cursor': cursor,
+        'campos': campos,
+        'ativo': ativo,
+        'dia': dia,
+        'hora_de': intervalo.get('de'),
+        'hora_ate': intervalo.get('ate'),
+    }
+
+# Versão dos horários de cada usuário (chave de cache da agenda)
+def versao_horarios(usuario_id):
+    registro = db.session.get(VersaoHorarios, usuario_id)
+    return registro.versao if registro else 0
+
+def incrementar_versao_horarios(usuario_id):
+    """Marca os horários do usuário como alterados; gravado no mesmo commit da alteração"""
+    registro = db.session.get(VersaoHorarios, usuario_id)
+    if registro is None:
+        registro = VersaoHorarios(usuario_id=usuario_id, versao=0)
+        db.session.add(registro)
+    registro.versao = (registro.versao or 0) + 1
+
+# Ajuste das durações pela previsão do tempo (ver clima.py); sem PREVISAO_CAMINHO não há ajuste
+motor_clima = MotorClima(
+    FontePrevisaoArquivo(os.environ['PREVISAO_CAMINHO']) if os.environ.get('PREVISAO_CAMINHO') else None,
+    latitude=float(os.environ.get('PREVISAO_LATITUDE', -15.79)),
+    et_referencia=float(os.environ.get('CLIMA_ET_REFERENCIA', 5.0)),
+    fator_min=float(os.environ.get('CLIMA_FATOR_MIN', 0.0)),
+    fator_max=float(os.environ.get('CLIMA_FATOR_MAX', 1.5)),
+)
+
+# Expansão da agenda (ocorrências concretas dos horários num intervalo de datas)
+AGENDA_MAX_DIAS = 366
+AGENDA_MAX_PROXIMOS = 50
+AGENDA_CACHE_MAX = 256
+# Teto de ocorrências somando todas as entradas do cache, e de uma entrada só;
+# intervalos maiores que o teto por entrada são só transmitidos, sem cache
+AGENDA_CACHE_MAX_OCORRENCIAS = 100000
+AGENDA_CACHE_MAX_POR_ENTRADA = 10000
+
+def localizar_br(dia, horas, minutos):
+    """Cria o datetime de Brasília para a data/hora local, tratando o horário de verão.
+
+    Horários inexistentes (início do horário de verão) são empurrados para a
+    frente; horários ambíguos (fim do horário de verão) usam só a primeira
+    ocorrência, para não regar duas vezes.
+    """
+    ingenuo = datetime(dia.year, dia.month, dia.day, horas, minutos)
+    try:
+        return BRASILIA_TZ.localize(ingenuo, is_dst=None)
+    except pytz.NonExistentTimeError:
+        return BRASILIA_TZ.normalize(BRASILIA_TZ.localize(ingenuo, is_dst=False))
+    except pytz.AmbiguousTimeError:
+        return BRASILIA_TZ.localize(ingenuo, is_dst=True)
+
+def expandir_agenda(horarios, inicio, fim, duracao_efetiva=None):
+    """Gera, em ordem cronológica e sob demanda, as ocorrências dos horários
+    entre as datas `inicio` e `fim` (inclusive).
+
+    `duracao_efetiva(horario, data)`, se informada, preenche a duração ajustada pelo clima;
+    ocorrências com duração efetiva zero saem com `suprimida` verdadeiro.
+    """
+    # Pré-processa os horários uma única vez: (horas, minutos, dias, horario)
+    preparados = []
+    for h in horarios:
+        partes = partes_hora(h.hora)
+        if partes is None:
+            continue
+        horas, minutos = partes
+        dias = {d.strip() for d in (h.dias_semana or '').split(',')}
+        preparados.append((horas, minutos, dias, h))
+    preparados.sort(key=lambda p: (p[0], p[1], p[3].id))
+
+    dia = inicio
+    while dia <= fim:
+        nome_dia = DIAS_SEMANA[dia.weekday()]
+        ocorrencias = [(localizar_br(dia, horas, minutos), h)
+                       for horas, minutos, dias, h in preparados if nome_dia in dias]
+        # A correção do horário de verão pode inverter a ordem dentro do dia
+        ocorrencias.sort(key=lambda o: o[0])
+        for momento, h in ocorrencias:
+            efetiva = duracao_efetiva(h, dia) if duracao_efetiva else h.duracao
+            yield {
+                'horario_id': h.id,
+                'inicio': momento.isoformat(),
+                'data': dia.isoformat(),
+                'dia': nome_dia,
+                'hora': momento.strftime('%H:%M'),
+                'duracao': h.duracao,
+                'duracao_efetiva': efetiva,
+                # Mesma regra do /status: duração efetiva zero (chuva prevista) não rega
+                'suprimida': not efetiva,
+            }
+        dia += timedelta(days=1)
+
+_cache_agenda = OrderedDict()
+_cache_agenda_lock = threading.Lock()
+_cache_agenda_total = 0
+
+def agenda_usuario(usuario_id, inicio, fim):
+    """Ocorrências do usuário no intervalo, com cache por usuário+intervalo+versão.
+
+    Em caso de cache miss o gerador é consumido sob demanda e o resultado só é
+    guardado se a expansão chegar ao fim (cliente que desconecta não polui o cache)
+    e não passar de AGENDA_CACHE_MAX_POR_ENTRADA ocorrências.
+    """
+    chave = (usuario_id, versao_horarios(usuario_id), motor_clima.revisao(), inicio, fim)
+    with _cache_agenda_lock:
+        if chave in _cache_agenda:
+            _cache_agenda.move_to_end(chave)
+            return iter(_cache_agenda[chave])
+
+    horarios = db.session.query(
+        HorarioRega.id, HorarioRega.hora, HorarioRega.duracao, HorarioRega.dias_semana
+    ).filter_by(usuario_id=usuario_id, ativo=True).all()
+
+    # Durações efetivas de todos os horários em todos os dias da previsão, num lote só
+    datas, matriz = motor_clima.tabela_duracoes([h.duracao or 0 for h in horarios])
+    efetivas = {(h.id, dia): int(matriz[i, j]) for i, h in enumerate(horarios) for j, dia in enumerate(datas)}
+
+    def duracao_efetiva(horario, dia):
+        return efetivas.get((horario.id, dia), horario.duracao)
+
+    def gerar():
+        global _cache_agenda_total
+        acumulado = []
+        for ocorrencia in expandir_agenda(horarios, inicio, fim, duracao_efetiva):
+            if acumulado is not None:
+                acumulado.append(ocorrencia)
+                if len(acumulado) > AGENDA_CACHE_MAX_POR_ENTRADA:
+                    acumulado = None
+            yield ocorrencia
+        if acumulado is None:
+            return
+        with _cache_agenda_lock:
+            if chave in _cache_agenda:
+                return
+            _cache_agenda[chave] = acumulado
+            _cache_agenda_total += len(acumulado)
+            while len(_cache_agenda) > AGENDA_CACHE_MAX or _cache_agenda_total > AGENDA_CACHE_MAX_OCORRENCIAS:
+                _cache_agenda_total -= len(_cache_agenda.popitem(last=False)[1])
+    return gerar()
+
+def proximas_ocorrencias(usuario_id, quantidade, agora=None):
+    """As próximas `quantidade` regas a partir do minuto atual (as suprimidas pelo clima ficam de fora)"""
+    agora = (agora or agora_br()).replace(second=0, microsecond=0)
+    hoje = agora.date()
+    # Horários são semanais: oito dias cobrem qualquer próxima ocorrência
+    # Materializa a semana inteira para que ela fique no cache entre as consultas
+    semana = list(agenda_usuario(usuario_id, hoje, hoje + timedelta(days=7)))
+    proximas = []
+    for ocorrencia in semana:
+        if not ocorrencia['suprimida'] and datetime.fromisoformat(ocorrencia['inicio']) >= agora:
+            proximas.append(ocorrencia)
+            if len(proximas) >= quantidade:
+                break
+    return proximas
+
+# Tarefas em segundo plano (exportações, relatórios, manutenção)
+gerenciador_tarefas = GerenciadorTarefas(
+    app, db, Tarefa,
+    agora=lambda: agora_br().replace(tzinfo=None),
+    referencia='app:gerenciador_tarefas',
+    max_processos=int(os.environ.get('TAREFAS_PROCESSOS', 2)),
+    max_threads=int(os.environ.get('TAREFAS_THREADS', 4)),
+)
+PASTA_EXPORTACOES = os.path.join(app.instance_path, 'exportacoes')
+
+@gerenciador_tarefas.registrar('exportar_horarios')
+def tarefa_exportar_horarios(contexto):
+    """Exporta todos os horários do usuário para CSV, página a página"""
+    import csv
+    os.makedirs(PASTA_EXPORTACOES, exist_ok=True)
+    nome = f'horarios-{contexto.tarefa_id}.csv'
+    total = db.session.query(db.func.count(HorarioRega.id)).filter_by(usuario_id=contexto.usuario_id).scalar()
+    linhas = 0
+    cursor = None
+    with open(os.path.join(PASTA_EXPORTACOES, nome), 'w', newline='', encoding='utf-8') as arquivo:
+        escritor = csv.writer(arquivo)
+        escritor.writerow(CAMPOS_HORARIO)
+        while True:
+            pagina, cursor = consultar_horarios(contexto.usuario_id, limite=LIMITE_PAGINA_MAXIMO, cursor=cursor)
+            escritor.writerows([[getattr(h, c) for c in CAMPOS_HORARIO] for h in pagina])
+            linhas += len(pagina)
+            contexto.progresso(linhas / total if total else 1.0, f'{linhas} de {total} horários')
+            if cursor is None:
+                break
+    return {'arquivo': nome, 'linhas': linhas}
+
+@gerenciador_tarefas.registrar('relatorio_agenda', cpu=True)
+def tarefa_relatorio_agenda(contexto, dias=30):
+    """Totais de regas e minutos por dia da semana nos próximos `dias` dias"""
+    dias = max(1, min(int(dias), AGENDA_MAX_DIAS))
+    inicio = agora_br().date()
+    por_dia = {d: {'regas': 0, 'minutos': 0} for d in DIAS_SEMANA}
+    total = 0
+    for ocorrencia in agenda_usuario(contexto.usuario_id, inicio, inicio + timedelta(days=dias - 1)):
+        if ocorrencia['suprimida']:
+            continue
+        por_dia[ocorrencia['dia']]['regas'] += 1
+        # Minutos que de fato serão regados, já com o ajuste pela previsão do tempo
+        por_dia[ocorrencia['dia']]['minutos'] += ocorrencia['duracao_efetiva']
+        total += 1
+        if total % 1000 == 0:
+            contexto.progresso((date.fromisoformat(ocorrencia['data']) - inicio).days / dias)
+    return {
+        'inicio': inicio.isoformat(),
+        'dias': dias,
+        'regas': total,
+        'minutos': sum(d['minutos'] for d in por_dia.values()),
+        'por_dia_semana': por_dia,
+    }
+
+if os.environ.get('TAREFAS_WORKER_EMBUTIDO') == '1' and PROCESSO_PRINCIPAL:
+    # Para implantações com um único processo; o normal é rodar "flask tarefas-worker".
+    # Os processos filhos do pool de CPU também importam este módulo e não iniciam outro.
+    gerenciador_tarefas.iniciar_thread()
+
+# Arquivamento do histórico antigo em arquivos colunares (ver arquivo_historico.py)
+RETENCAO_DIAS = {
+    'eventos': int(os.environ.get('RETENCAO_DIAS_EVENTOS', 180)),
+    'leituras': int(os.environ.get('RETENCAO_DIAS_LEITURAS', 30)),
+}
+arquivador = Arquivador(db, os.environ.get('ARQUIVO_PASTA', os.path.join(app.instance_path, 'arquivo')), [
+    TabelaArquivavel('eventos', EventoRega, 'inicio',
+                     [('id', INTEIRO), ('dispositivo', TEXTO), ('inicio', TEMPO), ('duracao', INTEIRO)]),
+    TabelaArquivavel('leituras', LeituraSensor, 'medido_em',
+                     [('id', INTEIRO), ('dispositivo', TEXTO), ('sensor', TEXTO), ('valor', REAL), ('medido_em', TEMPO)]),
+])
+
+def arquivar_historico(tabelas=None, progresso=None):
+    """Aplica a política de retenção às tabelas (padrão: todas)"""
+    agora = agora_br().replace(tzinfo=None)
+    return [
+        arquivador.arquivar(nome, agora - timedelta(days=RETENCAO_DIAS[nome]), progresso=progresso)
+        for nome in (tabelas or RETENCAO_DIAS)
+    ]
+
+# Afeta os dados de todos os usuários: não pode ser pedida pela API web
+@gerenciador_tarefas.registrar('arquivar_historico', max_tentativas=5, web=False)
+def tarefa_arquivar_historico(contexto, tabelas: list = None):
+    # Não há total conhecido de antemão; o progresso informa só as linhas já movidas
+    return arquivar_historico(tabelas, progresso=lambda n: contexto.progresso(0, f'{n} linhas arquivadas'))
+
+def registrar_evento_rega(dispositivo, agora, duracao):
+    """Grava a rega no histórico uma vez por dispositivo e minuto"""
+    inicio = agora.replace(second=0, microsecond=0, tzinfo=None)
+    try:
+        existe = db.session.query(EventoRega.id).filter_by(dispositivo=dispositivo, inicio=inicio).first()
+        if not existe:
+            db.session.add(EventoRega(dispositivo=dispositivo, inicio=inicio, duracao=duracao))
+            db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"⚠️ Erro ao registrar evento de rega: {e}")
+
+# Controle de admissão das rotas de dispositivo (ver admissao.py).
+# O firmware deve se identificar no cabeçalho X-Dispositivo-Id (ou ?dispositivo=...)
+# com um id fixo por placa: cada id tem seu balde, e o IP de origem tem outro,
+# mais folgado, que limita quem troca de id a cada requisição.
+ENDPOINTS_DISPOSITIVO = {'status_api', 'registrar_leituras'}
+controle_admissao = ControleAdmissao(
+    taxa_dispositivo=float(os.environ.get('ADMISSAO_TAXA_DISPOSITIVO', 1.0)),
+    rajada_dispositivo=int(os.environ.get('ADMISSAO_RAJADA_DISPOSITIVO', 5)),
+    taxa_global=float(os.environ.get('ADMISSAO_TAXA_GLOBAL', 50.0)),
+    rajada_global=int(os.environ.get('ADMISSAO_RAJADA_GLOBAL', 100)),
+    # Uma thread do worker fica sempre livre para a interface web. Os limites
+    # valem por processo: no total, multiplique por WEB_CONCURRENCY.
+    max_concorrentes=int(os.environ.get('ADMISSAO_MAX_CONCORRENTES', max(1, perfil['threads'] - 1))),
+    taxa_origem=float(os.environ.get('ADMISSAO_TAXA_ORIGEM', 10.0)),
+    rajada_origem=int(os.environ.get('ADMISSAO_RAJADA_ORIGEM', 20)),
+)
+
+def dispositivo_informado():
+    """Identificador enviado pelo firmware, ou None"""
+    return (request.headers.get('X-Dispositivo-Id') or request.args.get('dispositivo') or '').strip()[:64] or None
+
+def identificar_dispositivo():
+    """Identificador enviado pelo firmware ou, na falta dele, o IP de origem"""
+    return dispositivo_informado() or request.remote_addr or 'desconhecido'
+
+# Credencial dos controladores: cada id tem sua chave, derivada de um segredo do
+# servidor (gere com "flask chave-dispositivo <id>" e grave no firmware, que a
+# envia no cabeçalho X-Dispositivo-Chave). Sem CHAVE_DISPOSITIVOS nenhum
+# dispositivo é aceito nas rotas que gravam dados.
+CHAVE_DISPOSITIVOS = os.environ.get('CHAVE_DISPOSITIVOS', '')
+
+def chave_dispositivo(dispositivo):
+    return hmac.new(CHAVE_DISPOSITIVOS.encode('utf-8'), dispositivo.encode('utf-8'), hashlib.sha256).hexdigest()[:32]
+
+def dispositivo_autenticado():
+    """Id do dispositivo se ele apresentou a chave correta, senão None"""
+    dispositivo = dispositivo_informado()
+    chave = request.headers.get('X-Dispositivo-Chave', '')
+    if not (CHAVE_DISPOSITIVOS and dispositivo and chave):
+        return None
+    return dispositivo if hmac.compare_digest(chave.encode(), chave_dispositivo(dispositivo).encode()) else None
+
+@app.before_request
+def admitir_dispositivo():
+    # Roda antes da view: a rejeição não toca no banco nem em templates
+    if request.endpoint not in ENDPOINTS_DISPOSITIVO:
+        return None
+    admitido, retry_after = controle_admissao.admitir(identificar_dispositivo(), request.remote_addr)
+    if not admitido:
+        return Response('{"erro": "Muitas requisições"}', status=429, mimetype='application/json',
+                        headers={'Retry-After': str(retry_after)})
+    g.admissao_dispositivo = True
+    return None
+
+@app.teardown_request
+def liberar_dispositivo(exc):
+    if g.pop('admissao_dispositivo', False):
+        controle_admissao.liberar()
+
 # Rotas de autenticação
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -199,8 +747,20 @@ def dashboard():
 @app.route('/horarios')
 @login_required
 def horarios():
-    horarios_usuario = HorarioRega.query.filter_by(usuario_id=current_user.id).order_by(HorarioRega.hora).all()
-    return render_template('horarios.html', horarios=horarios_usuario)
+    try:
+        parametros = parametros_listagem(request.args)
+    except ValueError as e:
+        if request.args.get('parcial'):
+            return str(e), 400
+        flash(str(e), 'danger')
+        return redirect(url_for('horarios'))
+    horarios_usuario, proximo_cursor = consultar_horarios(current_user.id, **parametros)
+    # "Carregar mais" busca só o fragmento com os próximos itens da lista
+    if request.args.get('parcial'):
+        resposta = app.make_response(render_template('_horarios_itens.html', horarios=horarios_usuario))
+        resposta.headers['X-Proximo-Cursor'] = proximo_cursor or ''
+        return resposta
+    return render_template('horarios.html', horarios=horarios_usuario, proximo_cursor=proximo_cursor)
 
 @app.route('/adicionar_horario', methods=['POST'])
 @login_required
@@ -212,7 +772,7 @@ def adicionar_horario():
         novos_dias_semana = dados['dias_semana']
 
         # Validação do formato da hora (HH:MM)
-        if not re.match(r'^(?:2[0-3]|[01]?[0-9]):(?:[0-5]?[0-9])$', nova_hora):
+        if not re.match(REGEX_HORA, nova_hora):
             return jsonify({'sucesso': False, 'erro': 'Formato de hora inválido. Use HH:MM.'}), 400
         if not (1 <= nova_duracao <= 1440): # Duração entre 1 minuto e 24 horas
             return jsonify({'sucesso': False, 'erro': 'Duração inválida. Use um valor entre 1 e 1440 minutos.'}), 400
@@ -220,12 +780,13 @@ def adicionar_horario():
             return jsonify({'sucesso': False, 'erro': 'Selecione pelo menos um dia da semana.'}), 400
 
         novo_horario = HorarioRega(
-            hora=nova_hora,
+            hora=normalizar_hora(nova_hora),
             duracao=nova_duracao,
             dias_semana=novos_dias_semana,
             usuario_id=current_user.id
         )
         db.session.add(novo_horario)
+        incrementar_versao_horarios(current_user.id)
         db.session.commit()
         return jsonify({'sucesso': True})
     except Exception as e:
@@ -255,7 +816,7 @@ def editar_horario(horario_id):
             novo_ativo = request.form.get('ativo') == 'on' # Checkbox retorna 'on' ou None
 
             # Validação do formato da hora (HH:MM)
-            if not re.match(r'^(?:2[0-3]|[01]?[0-9]):(?:[0-5]?[0-9])$', nova_hora):
+            if not re.match(REGEX_HORA, nova_hora):
                 flash('Formato de hora inválido. Use HH:MM.', 'danger')
                 return render_template('editar_horario.html', title='Editar Horário', horario=horario, dias_semana_list=['Seg', 'Ter', 'Qua', 'Qui', 'Sex', 'Sab', 'Dom'])
             if not (1 <= nova_duracao <= 1440): # Duração entre 1 minuto e 24 horas
@@ -266,10 +827,11 @@ def editar_horario(horario_id):
                 return render_template('editar_horario.html', title='Editar Horário', horario=horario, dias_semana_list=['Seg', 'Ter', 'Qua', 'Qui', 'Sex', 'Sab', 'Dom'])
 
             # Atualiza o objeto HorarioRega com os novos dados
-            horario.hora = nova_hora
+            horario.hora = normalizar_hora(nova_hora)
             horario.duracao = nova_duracao
             horario.dias_semana = novos_dias_semana
             horario.ativo = novo_ativo
+            incrementar_versao_horarios(current_user.id)
 
             db.session.commit() # Salva as alterações no banco de dados
             flash('Agendamento atualizado com sucesso!', 'success')
@@ -295,6 +857,7 @@ def deletar_horario(id):
         if horario.usuario_id != current_user.id:
             return jsonify({'sucesso': False, 'erro': 'Não autorizado'}), 403
         db.session.delete(horario)
+        incrementar_versao_horarios(current_user.id)
         db.session.commit()
         return jsonify({'sucesso': True})
     except Exception as e:
@@ -311,6 +874,7 @@ def ativar_horario(id):
             return jsonify({'sucesso': False, 'erro': 'Não autorizado'}), 403
         dados = request.get_json()
         horario.ativo = dados['ativo']
+        incrementar_versao_horarios(current_user.id)
         db.session.commit()
         return jsonify({'sucesso': True})
     except Exception as e:
@@ -320,24 +884,224 @@ def ativar_horario(id):
 
 @app.route('/status')
 def status_api():
-    regar, duracao = verificar_horario_rega()
+    agora = agora_br()
+    regar, duracao_base = verificar_horario_rega()
+    # Fator do dia vem do cache da previsão: custo constante por consulta
+    fator = motor_clima.fator(agora.date())
+    duracao = int(round(duracao_base * fator)) if regar else 0
+    if regar and duracao == 0:
+        # Chuva suficiente prevista para o dia: a rega é suprimida
+        regar = False
+    # Só controladores autenticados entram no histórico: a página de status,
+    # que consulta esta rota a cada 5 s pelo navegador, não tem credencial
+    dispositivo = dispositivo_autenticado()
+    if regar and dispositivo:
+        registrar_evento_rega(dispositivo, agora, duracao)
     return jsonify({
         'regar': regar,
         'duracao': duracao,
-        'timestamp': agora_br().isoformat()
+        'duracao_base': duracao_base,
+        'fator_clima': fator,
+        'timestamp': agora.isoformat()
     })
 
+# Relógio do dispositivo adiantado além disto é erro de configuração, não leitura
+LEITURAS_TOLERANCIA_RELOGIO = timedelta(minutes=5)
+
+@app.route('/leituras', methods=['POST'])
+def registrar_leituras():
+    """Recebe {"leituras": [{"sensor": "umidade_solo", "valor": 41.5, "medido_em": "<ISO>"}]}
+
+    Exige X-Dispositivo-Id + X-Dispositivo-Chave. medido_em não pode estar no
+    futuro (tolerância de LEITURAS_TOLERANCIA_RELOGIO) nem antes do corte da retenção.
+    """
+    dispositivo = dispositivo_autenticado()
+    if dispositivo is None:
+        return jsonify({'sucesso': False, 'erro': 'Dispositivo não autenticado.'}), 401
+    dados = request.get_json(silent=True) or {}
+    leituras = dados.get('leituras')
+    if not isinstance(leituras, list) or not (1 <= len(leituras) <= 500):
+        return jsonify({'sucesso': False, 'erro': 'Envie de 1 a 500 leituras.'}), 400
+    agora = agora_br()
+    mais_cedo = agora - timedelta(days=RETENCAO_DIAS['leituras'])
+    mais_tarde = agora + LEITURAS_TOLERANCIA_RELOGIO
+    try:
+        for leitura in leituras:
+            medido_em = datetime.fromisoformat(leitura['medido_em']) if leitura.get('medido_em') else agora
+            if medido_em.tzinfo is None:
+                medido_em = BRASILIA_TZ.localize(medido_em)
+            if not mais_cedo <= medido_em <= mais_tarde:
+                raise ValueError(f'medido_em fora da janela aceita ({leitura["medido_em"]})')
+            db.session.add(LeituraSensor(
+                dispositivo=dispositivo,
+                sensor=str(leitura['sensor'])[:30],
+                valor=None if leitura.get('valor') is None else float(leitura['valor']),
+                medido_em=medido_em.astimezone(BRASILIA_TZ).replace(tzinfo=None),
+            ))
+        db.session.commit()
+    except (KeyError, TypeError, ValueError) as e:
+        db.session.rollback()
+        return jsonify({'sucesso': False, 'erro': f'Leitura inválida: {e}'}), 400
+    return jsonify({'sucesso': True, 'gravadas': len(leituras)})
+
+# Os dispositivos não pertencem a um usuário: uma instalação controla uma área só
+# (o /status atende os horários de todos) e o cadastro exige o código de convite,
+# então qualquer usuário é operador dela. HISTORICO_EMAILS restringe o histórico
+# a alguns deles (lista separada por vírgulas).
+HISTORICO_EMAILS = {e.strip().lower() for e in os.environ.get('HISTORICO_EMAILS', '').split(',') if e.strip()}
+
+@app.route('/api/historico/<tabela>')
+@login_required
+def historico_api(tabela):
+    """Transmite (NDJSON) o histórico de um intervalo: primeiro o arquivado, depois o do banco"""
+    if HISTORICO_EMAILS and current_user.email.lower() not in HISTORICO_EMAILS:
+        return jsonify({'sucesso': False, 'erro': 'Não autorizado'}), 403
+    if tabela not in arquivador.tabelas:
+        return jsonify({'sucesso': False, 'erro': f"Tabela inválida. Use: {', '.join(arquivador.tabelas)}."}), 400
+    def horario_local(valor):
+        # O histórico é gravado em horário de Brasília sem fuso, como em /leituras
+        momento = datetime.fromisoformat(valor)
+        if momento.tzinfo is not None:
+            momento = momento.astimezone(BRASILIA_TZ).replace(tzinfo=None)
+        return momento
+
+    try:
+        inicio = horario_local(request.args['inicio']) if request.args.get('inicio') else None
+        fim = horario_local(request.args['fim']) if request.args.get('fim') else None
+    except ValueError:
+        return jsonify({'sucesso': False, 'erro': 'Datas inválidas. Use AAAA-MM-DD[THH:MM][±HH:MM].'}), 400
+    dispositivo = request.args.get('dispositivo')
+    definicao = arquivador.tabelas[tabela]
+    modelo = definicao.modelo
+    coluna_tempo = getattr(modelo, definicao.coluna_tempo)
+
+    def serializar(linha):
+        return json.dumps({k: v.isoformat() if isinstance(v, datetime) else v for k, v in linha.items()}) + '\n'
+
+    def gerar():
+        for linha in arquivador.ler(tabela, inicio, fim, dispositivo):
+            yield serializar(linha)
+        consulta = db.select(*[getattr(modelo, nome) for nome, _ in definicao.colunas])
+        if inicio:
+            consulta = consulta.where(coluna_tempo >= inicio)
+        if fim:
+            consulta = consulta.where(coluna_tempo < fim)
+        if dispositivo:
+            consulta = consulta.where(modelo.dispositivo == dispositivo)
+        for linha in db.session.execute(consulta.order_by(modelo.dispositivo, coluna_tempo).execution_options(yield_per=1000)):
+            yield serializar(dict(linha._mapping))
+
+    return Response(stream_with_context(gerar()), mimetype='application/x-ndjson')
+
 @app.route('/api/horarios')
 @login_required # Adiciona a exigência de login
 def listar_horarios_api():
-    # Agora filtra apenas os horários do usuário logado que estão ativos
-    horarios = HorarioRega.query.filter_by(usuario_id=current_user.id, ativo=True).all()
-    return jsonify([{
-        'id': h.id,
-        'hora': h.hora,
-        'duracao': h.duracao,
-        'dias_semana': h.dias_semana
-    } for h in horarios])
+    # Por padrão lista apenas os horários ativos do usuário logado (ativo=todos lista tudo)
+    try:
+        parametros = parametros_listagem(request.args, ativo_padrao=True)
+    except ValueError as e:
+        return jsonify({'sucesso': False, 'erro': str(e)}), 400
+    horarios, proximo_cursor = consultar_horarios(current_user.id, **parametros)
+    campos = parametros['campos']
+    return jsonify({
+        'horarios': [{c: getattr(h, c) for c in campos} for h in horarios],
+        'proximo_cursor': proximo_cursor,
+    })
+
+@app.route('/api/agenda')
+@login_required
+def agenda_api():
+    """Ocorrências concretas dos horários do usuário.
+
+    ?proximos=N retorna as N próximas regas; ?inicio=AAAA-MM-DD&fim=AAAA-MM-DD
+    expande um intervalo (padrão: hoje + 6 dias) transmitido como array JSON ou,
+    com ?formato=ndjson, uma ocorrência por linha.
+    """
+    if request.args.get('proximos'):
+        try:
+            quantidade = int(request.args['proximos'])
+        except ValueError:
+            quantidade = 0
+        if not (1 <= quantidade <= AGENDA_MAX_PROXIMOS):
+            return jsonify({'sucesso': False, 'erro': f'Parâmetro proximos deve estar entre 1 e {AGENDA_MAX_PROXIMOS}.'}), 400
+        return jsonify(proximas_ocorrencias(current_user.id, quantidade))
+
+    hoje = agora_br().date()
+    try:
+        inicio = date.fromisoformat(request.args['inicio']) if request.args.get('inicio') else hoje
+        fim = date.fromisoformat(request.args['fim']) if request.args.get('fim') else inicio + timedelta(days=6)
+    except ValueError:
+        return jsonify({'sucesso': False, 'erro': 'Datas inválidas. Use AAAA-MM-DD.'}), 400
+    if fim < inicio or (fim - inicio).days >= AGENDA_MAX_DIAS:
+        return jsonify({'sucesso': False, 'erro': f'Intervalo inválido (máximo de {AGENDA_MAX_DIAS} dias).'}), 400
+
+    ocorrencias = agenda_usuario(current_user.id, inicio, fim)
+
+    if request.args.get('formato') == 'ndjson':
+        def gerar_ndjson():
+            for ocorrencia in ocorrencias:
+                yield json.dumps(ocorrencia) + '\n'
+        return Response(stream_with_context(gerar_ndjson()), mimetype='application/x-ndjson')
+
+    def gerar_json():
+        separador = '['
+        for ocorrencia in ocorrencias:
+            yield separador + json.dumps(ocorrencia)
+            separador = ','
+        yield '[]' if separador == '[' else ']'
+    return Response(stream_with_context(gerar_json()), mimetype='application/json')
+
+@app.route('/api/tarefas', methods=['POST'])
+@login_required
+def criar_tarefa():
+    """Só enfileira; o processamento acontece no worker de tarefas"""
+    dados = request.get_json(silent=True) or {}
+    parametros = dados.get('parametros') or {}
+    if not isinstance(parametros, dict):
+        return jsonify({'sucesso': False, 'erro': 'parametros deve ser um objeto JSON.'}), 400
+    try:
+        tarefa = gerenciador_tarefas.enfileirar(dados.get('tipo'), parametros, usuario_id=current_user.id, web=True)
+    except ValueError as e:
+        return jsonify({'sucesso': False, 'erro': f'{e}.'}), 400
+    return jsonify({'sucesso': True, 'id': tarefa.id,
+                    'url': url_for('consultar_tarefa', tarefa_id=tarefa.id)}), 202
+
+def tarefa_do_usuario(tarefa_id):
+    tarefa = db.get_or_404(Tarefa, tarefa_id)
+    if tarefa.usuario_id != current_user.id:
+        return None
+    return tarefa
+
+@app.route('/api/tarefas/<int:tarefa_id>')
+@login_required
+def consultar_tarefa(tarefa_id):
+    tarefa = tarefa_do_usuario(tarefa_id)
+    if tarefa is None:
+        return jsonify({'sucesso': False, 'erro': 'Não autorizado'}), 403
+    return jsonify(tarefa.to_dict())
+
+@app.route('/api/tarefas/<int:tarefa_id>/cancelar', methods=['POST'])
+@login_required
+def cancelar_tarefa(tarefa_id):
+    tarefa = tarefa_do_usuario(tarefa_id)
+    if tarefa is None:
+        return jsonify({'sucesso': False, 'erro': 'Não autorizado'}), 403
+    if tarefa.estado in ESTADOS_FINAIS:
+        return jsonify({'sucesso': False, 'erro': f'Tarefa já está {tarefa.estado}.'}), 409
+    gerenciador_tarefas.cancelar(tarefa_id)
+    return jsonify({'sucesso': True})
+
+@app.route('/api/tarefas/<int:tarefa_id>/arquivo')
+@login_required
+def baixar_arquivo_tarefa(tarefa_id):
+    tarefa = tarefa_do_usuario(tarefa_id)
+    if tarefa is None:
+        return jsonify({'sucesso': False, 'erro': 'Não autorizado'}), 403
+    resultado = json.loads(tarefa.resultado) if tarefa.resultado else {}
+    # Nem toda tarefa produz arquivo (p. ex. arquivar_historico devolve uma lista)
+    if tarefa.estado != 'concluida' or not isinstance(resultado, dict) or not resultado.get('arquivo'):
+        return jsonify({'sucesso': False, 'erro': 'Tarefa sem arquivo disponível.'}), 404
+    return send_from_directory(PASTA_EXPORTACOES, resultado['arquivo'], as_attachment=True)
 
 # NOVA ROTA: Página de Status da ESP32
 @app.route('/esp32_status')
@@ -349,6 +1113,103 @@ def esp32_status():
 def health():
     return jsonify({'status': 'ok'}), 200
 
+def pool_metricas():
+    pool = db.engine.pool
+    metricas = {'classe': type(pool).__name__}
+    if usa_postgres:
+        metricas.update(estatisticas_pool.resumo(),
+                        tamanho=pool.size(), em_uso=pool.checkedout(), overflow=pool.overflow())
+    return metricas
+
+# Coletores de métricas (sem sessão) mandam "Authorization: Bearer <METRICAS_TOKEN>"
+METRICAS_TOKEN = os.environ.get('METRICAS_TOKEN', '')
+
+@app.route('/metricas')
+def metricas():
+    # Contadores deste processo (cada worker do gunicorn tem os seus)
+    token = request.headers.get('Authorization', '').removeprefix('Bearer ').strip()
+    autorizado = current_user.is_authenticated or (METRICAS_TOKEN and hmac.compare_digest(token.encode(), METRICAS_TOKEN.encode()))
+    if not autorizado:
+        return jsonify({'sucesso': False, 'erro': 'Não autorizado'}), 401
+    return jsonify({
+        'pid': os.getpid(),
+        'admissao': controle_admissao.metricas(),
+        'pool': pool_metricas(),
+    })
+
+@app.cli.command('simular')
+@click.option('--inicio', help='Data inicial AAAA-MM-DD (padrão: hoje).')
+@click.option('--dias', default=7, show_default=True, help='Dias simulados.')
+@click.option('--intervalos', default='15,30,45,60,90', show_default=True,
+              help='Intervalos de consulta do dispositivo, em segundos.')
+@click.option('--jitter', default=5.0, show_default=True, help='Variação aleatória (±s) de cada intervalo.')
+@click.option('--perda', default=0.0, show_default=True, help='Probabilidade de uma consulta se perder.')
+@click.option('--usuario', type=int, help='Simula apenas os horários deste usuário.')
+@click.option('--semente', default=0, show_default=True, help='Semente do gerador aleatório.')
+def simular_comando(inicio, dias, intervalos, jitter, perda, usuario, semente):
+    """Reproduz as consultas dos dispositivos contra os horários ativos e
+    relata regas perdidas e duplicadas por intervalo de consulta."""
+    from simulacao import comparar_intervalos
+
+    consulta = HorarioRega.query.filter_by(ativo=True)
+    if usuario:
+        consulta = consulta.filter_by(usuario_id=usuario)
+    horarios = consulta.all()
+    try:
+        data_inicio = date.fromisoformat(inicio) if inicio else agora_br().date()
+    except ValueError:
+        raise click.BadParameter('use o formato AAAA-MM-DD.', param_hint='--inicio')
+    try:
+        lista_intervalos = [float(i) for i in intervalos.split(',')]
+    except ValueError:
+        raise click.BadParameter('use segundos separados por vírgula, p. ex. 15,30,60.', param_hint='--intervalos')
+    if min(lista_intervalos) <= 0:
+        raise click.BadParameter('os intervalos devem ser maiores que zero.', param_hint='--intervalos')
+    if not 0 <= perda <= 1:
+        raise click.BadParameter('deve ficar entre 0 e 1.', param_hint='--perda')
+    if not 0 <= jitter < min(lista_intervalos):
+        raise click.BadParameter(f'deve ficar entre 0 e o menor intervalo ({min(lista_intervalos):g}s).',
+                                 param_hint='--jitter')
+    relatorios = comparar_intervalos(
+        horarios, localizar_br(data_inicio, 0, 0), dias,
+        lista_intervalos, jitter=jitter, perda=perda, semente=semente,
+    )
+
+    click.echo(f'{len(horarios)} horários ativos, {dias} dias a partir de {data_inicio:%d/%m/%Y}')
+    click.echo(f"{'intervalo':>9} {'consultas':>9} {'esperadas':>9} {'perdidas':>8} {'duplicadas':>10} {'espúrias':>8}")
+    for r in relatorios:
+        click.echo(f"{r['intervalo']:>8g}s {r['consultas']:>9} {r['esperadas']:>9} {len(r['perdidas']):>8} "
+                   f"{len(r['duplicadas']):>10} {len(r['espurias']):>8}")
+    for r in relatorios:
+        for momento in r['perdidas'][:5]:
+            click.echo(f"  {r['intervalo']:g}s: rega perdida em {momento}")
+
+@app.cli.command('chave-dispositivo')
+@click.argument('dispositivo')
+def chave_dispositivo_comando(dispositivo):
+    """Mostra a chave que o firmware do DISPOSITIVO deve enviar em X-Dispositivo-Chave."""
+    if not CHAVE_DISPOSITIVOS:
+        raise click.UsageError('Defina CHAVE_DISPOSITIVOS no ambiente do servidor.')
+    click.echo(chave_dispositivo(dispositivo.strip()[:64]))
+
+@app.cli.command('tarefas-worker')
+def tarefas_worker_comando():
+    """Executa as tarefas enfileiradas até ser interrompido (Ctrl+C)."""
+    click.echo(f'👷 Worker de tarefas: {gerenciador_tarefas.max_threads} threads, '
+               f'{gerenciador_tarefas.max_processos} processos ({", ".join(gerenciador_tarefas.tipos)})')
+    try:
+        gerenciador_tarefas.executar_worker()
+    except KeyboardInterrupt:
+        click.echo('Worker encerrado.')
+
+@app.cli.command('arquivar')
+@click.option('--tabela', 'tabelas', multiple=True, type=click.Choice(sorted(RETENCAO_DIAS)),
+              help='Tabela a arquivar (padrão: todas).')
+def arquivar_comando(tabelas):
+    """Move o histórico mais antigo que a retenção para o arquivo colunar."""
+    for r in arquivar_historico(list(tabelas) or None):
+        click.echo(f"📦 {r['tabela']}: {r['linhas']} linhas em {r['arquivos']} arquivos")
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=True)
@@ -0,0 +1,173 @@
+"""Arquivamento colunar do histórico (eventos de rega e leituras de sensores).
+
+Linhas mais antigas que o corte de retenção saem das tabelas do banco e vão
+para arquivos .npz comprimidos, uma coluna por array, particionados por
+tabela, dispositivo e mês:
+
+    <pasta>/<tabela>/<dispositivo>/<AAAA-MM>/<id_inicial>-<id_final>.npz
+
+O nome do arquivo vem dos ids do lote, então repetir um lote interrompido
+(arquivo gravado, DELETE não confirmado) sobrescreve o mesmo arquivo.
+"""
+import os
+import re
+from datetime import datetime, timedelta
+
+import numpy as np
+
+EPOCA = datetime(1970, 1, 1)
+UM_MICROSSEGUNDO = timedelta(microseconds=1)
+
+# Tipos de coluna suportados e o dtype usado no arquivo
+TEMPO = 'tempo'   # datetime sem fuso -> int64 (microssegundos desde 1970)
+INTEIRO = 'int'   # int64
+REAL = 'float'    # float64 (None vira NaN)
+TEXTO = 'str'     # unicode de largura fixa (None vira '')
+
+
+class TabelaArquivavel:
+    """Descreve como uma tabela do banco é arquivada"""
+
+    def __init__(self, nome, modelo, coluna_tempo, colunas, coluna_dispositivo='dispositivo'):
+        self.nome = nome
+        self.modelo = modelo
+        self.coluna_tempo = coluna_tempo
+        self.coluna_dispositivo = coluna_dispositivo
+        # [(nome_da_coluna, tipo)], incluindo id, tempo e dispositivo
+        self.colunas = colunas
+
+
+def _codificar(valores, tipo):
+    if tipo == TEMPO:
+        return np.array([(v - EPOCA) // UM_MICROSSEGUNDO for v in valores], dtype=np.int64)
+    if tipo == INTEIRO:
+        return np.array(valores, dtype=np.int64)
+    if tipo == REAL:
+        return np.array([np.nan if v is None else v for v in valores], dtype=np.float64)
+    return np.array(['' if v is None else str(v) for v in valores], dtype=str)
+
+
+def _decodificar(valor, tipo):
+    if tipo == TEMPO:
+        return EPOCA + timedelta(microseconds=int(valor))
+    if tipo == INTEIRO:
+        return int(valor)
+    if tipo == REAL:
+        return None if np.isnan(valor) else float(valor)
+    return str(valor)
+
+
+def _nome_seguro(dispositivo):
+    return re.sub(r'[^A-Za-z0-9_.-]', '_', dispositivo or 'desconhecido')
+
+
+def _meses(inicio, fim):
+    """'AAAA-MM' de cada mês entre as duas datas (inclusive)"""
+    ano, mes = inicio.year, inicio.month
+    while (ano, mes) <= (fim.year, fim.month):
+        yield f'{ano:04d}-{mes:02d}'
+        ano, mes = (ano + 1, 1) if mes == 12 else (ano, mes + 1)
+
+
+class Arquivador:
+
+    def __init__(self, db, pasta, tabelas):
+        self.db = db
+        self.pasta = pasta
+        self.tabelas = {t.nome: t for t in tabelas}
+
+    def arquivar(self, nome_tabela, corte, lote=5000, progresso=None):
+        """Move para o arquivo as linhas com tempo anterior a `corte`, em lotes.
+
+        Cada lote é gravado em disco antes de ser apagado do banco.
+        `progresso(linhas_arquivadas)` é chamado ao fim de cada lote.
+        """
+        tabela = self.tabelas[nome_tabela]
+        modelo = tabela.modelo
+        coluna_tempo = getattr(modelo, tabela.coluna_tempo)
+        nomes = [nome for nome, _ in tabela.colunas]
+        total, arquivos = 0, set()
+        while True:
+            linhas = self.db.session.execute(
+                self.db.select(*[getattr(modelo, n) for n in nomes])
+                .where(coluna_tempo < corte).order_by(modelo.id).limit(lote)
+            ).all()
+            if not linhas:
+                break
+
+            particoes = {}
+            for linha in linhas:
+                registro = linha._mapping
+                chave = (registro[tabela.coluna_dispositivo], registro[tabela.coluna_tempo].strftime('%Y-%m'))
+                particoes.setdefault(chave, []).append(registro)
+            for (dispositivo, mes), registros in particoes.items():
+                arquivos.add(self._gravar_bloco(tabela, dispositivo, mes, registros))
+
+            ids = [linha.id for linha in linhas]
+            for i in range(0, len(ids), 1000):
+                self.db.session.execute(self.db.delete(modelo).where(modelo.id.in_(ids[i:i + 1000])))
+            self.db.session.commit()
+            total += len(linhas)
+            if progresso:
+                progresso(total)
+        return {'tabela': nome_tabela, 'linhas': total, 'arquivos': len(arquivos)}
+
+    def _gravar_bloco(self, tabela, dispositivo, mes, registros):
+        pasta = os.path.join(self.pasta, tabela.nome, _nome_seguro(dispositivo), mes)
+        os.makedirs(pasta, exist_ok=True)
+        caminho = os.path.join(pasta, f"{registros[0]['id']}-{registros[-1]['id']}.npz")
+        colunas = {nome: _codificar([r[nome] for r in registros], tipo) for nome, tipo in tabela.colunas}
+        # Grava num temporário e renomeia: leitores nunca veem um arquivo pela metade
+        temporario = caminho + '.tmp'
+        with open(temporario, 'wb') as arquivo:
+            np.savez_compressed(arquivo, **colunas)
+        os.replace(temporario, caminho)
+        return caminho
+
+    def ler(self, nome_tabela, inicio=None, fim=None, dispositivo=None):
+        """Gera as linhas arquivadas (dicts) com inicio <= tempo < fim.
+
+        A ordem é por dispositivo, mês e id; só os blocos dos meses pedidos são abertos.
+        """
+        tabela = self.tabelas[nome_tabela]
+        base = os.path.join(self.pasta, tabela.nome)
+        if not os.path.isdir(base):
+            return
+        if dispositivo is not None:
+            pastas_dispositivo = [_nome_seguro(dispositivo)]
+        else:
+            pastas_dispositivo = sorted(os.listdir(base))
+        limite_inicio = None if inicio is None else (inicio - EPOCA) // UM_MICROSSEGUNDO
+        limite_fim = None if fim is None else (fim - EPOCA) // UM_MICROSSEGUNDO
+
+        for pasta_dispositivo in pastas_dispositivo:
+            caminho_dispositivo = os.path.join(base, pasta_dispositivo)
+            if not os.path.isdir(caminho_dispositivo):
+                continue
+            meses = sorted(os.listdir(caminho_dispositivo))
+            if inicio is not None or fim is not None:
+                permitidos = set(_meses(inicio or datetime.strptime(meses[0], '%Y-%m'),
+                                        fim or datetime.strptime(meses[-1], '%Y-%m'))) if meses else set()
+                meses = [m for m in meses if m in permitidos]
+            for mes in meses:
+                caminho_mes = os.path.join(caminho_dispositivo, mes)
+                blocos = sorted((f for f in os.listdir(caminho_mes) if f.endswith('.npz')),
+                                key=lambda f: int(f.split('-')[0]))
+                for bloco in blocos:
+                    yield from self._ler_bloco(tabela, os.path.join(caminho_mes, bloco),
+                                               limite_inicio, limite_fim, dispositivo)
+
+    def _ler_bloco(self, tabela, caminho, limite_inicio, limite_fim, dispositivo):
+        with np.load(caminho) as dados:
+            colunas = {nome: dados[nome] for nome, _ in tabela.colunas}
+        # Filtro vetorizado antes de converter as linhas para Python
+        mascara = np.ones(len(colunas['id']), dtype=bool)
+        tempos = colunas[tabela.coluna_tempo]
+        if limite_inicio is not None:
+            mascara &= tempos >= limite_inicio
+        if limite_fim is not None:
+            mascara &= tempos < limite_fim
+        if dispositivo is not None:
+            mascara &= colunas[tabela.coluna_dispositivo] == dispositivo
+        for i in np.flatnonzero(mascara):
+            yield {nome: _decodificar(colunas[nome][i], tipo) for nome, tipo in tabela.colunas}
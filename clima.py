@@ -0,0 +1,166 @@
+"""Ajuste das durações de rega pela previsão do tempo.
+
+Uma fonte de previsão (plugável; aqui, um arquivo JSON local que funciona
+offline) fornece, por dia, temperaturas mínima/máxima e chuva prevista. O
+motor calcula a evapotranspiração de referência (Hargreaves) de todos os dias
+de uma vez com NumPy e transforma em fatores de ajuste aplicados sobre a
+`duracao` dos horários. Tudo fica em cache por revisão da previsão.
+
+Formato do arquivo:
+
+    {"revisao": "2026-10-19T06",            (opcional; padrão: nome+mtime)
+     "dias": [{"data": "2026-10-19", "tmin": 18.0, "tmax": 31.5, "chuva": 0.0}, ...]}
+"""
+import json
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from datetime import date
+
+import numpy as np
+
+# Constante solar (MJ m-2 min-1) e conversão de MJ m-2 dia-1 para mm dia-1
+CONSTANTE_SOLAR = 0.0820
+MJ_PARA_MM = 0.408
+
+
+class Previsao:
+    def __init__(self, revisao, dias):
+        self.revisao = revisao
+        # Listas paralelas, uma posição por dia
+        self.datas = [date.fromisoformat(d['data']) for d in dias]
+        self.tmin = np.array([float(d['tmin']) for d in dias])
+        self.tmax = np.array([float(d['tmax']) for d in dias])
+        self.chuva = np.array([float(d.get('chuva') or 0.0) for d in dias])
+
+
+class FontePrevisao(ABC):
+    """Interface das fontes de previsão"""
+
+    @abstractmethod
+    def obter(self):
+        """Retorna a Previsao mais recente (ou None se não houver)"""
+
+
+class FontePrevisaoArquivo(FontePrevisao):
+    """Lê a previsão de um arquivo JSON ou do JSON mais recente (por nome) de um diretório.
+
+    O sistema de arquivos é consultado no máximo a cada `intervalo` segundos;
+    entre uma consulta e outra a última previsão lida é reutilizada.
+    """
+
+    def __init__(self, caminho, intervalo=60):
+        self.caminho = caminho
+        self.intervalo = intervalo
+        self._verificado = None
+        self._assinatura = None
+        self._previsao = None
+        self._lock = threading.Lock()
+
+    def _arquivo_atual(self):
+        if os.path.isdir(self.caminho):
+            nomes = sorted(n for n in os.listdir(self.caminho) if n.endswith('.json'))
+            return os.path.join(self.caminho, nomes[-1]) if nomes else None
+        return self.caminho if os.path.exists(self.caminho) else None
+
+    def obter(self):
+        agora = time.monotonic()
+        if self._verificado is not None and agora - self._verificado < self.intervalo:
+            return self._previsao
+        with self._lock:
+            self._verificado = agora
+            try:
+                arquivo = self._arquivo_atual()
+                if arquivo is None:
+                    return self._previsao
+                info = os.stat(arquivo)
+                assinatura = f'{os.path.basename(arquivo)}:{info.st_mtime_ns}:{info.st_size}'
+                if assinatura != self._assinatura:
+                    with open(arquivo, encoding='utf-8') as f:
+                        dados = json.load(f)
+                    self._previsao = Previsao(str(dados.get('revisao') or assinatura), dados['dias'])
+                    self._assinatura = assinatura
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                # Mantém a última previsão válida
+                print(f"⚠️ Erro ao ler previsão do tempo: {e}")
+            return self._previsao
+
+
+def radiacao_extraterrestre(latitude, dias_do_ano):
+    """Ra (mm/dia de evaporação equivalente) para cada dia do ano, FAO-56 eq. 21"""
+    phi = np.radians(latitude)
+    fase = 2 * np.pi * dias_do_ano / 365
+    dr = 1 + 0.033 * np.cos(fase)
+    declinacao = 0.409 * np.sin(fase - 1.39)
+    ws = np.arccos(np.clip(-np.tan(phi) * np.tan(declinacao), -1.0, 1.0))
+    ra = (24 * 60 / np.pi) * CONSTANTE_SOLAR * dr * (
+        ws * np.sin(phi) * np.sin(declinacao) + np.cos(phi) * np.cos(declinacao) * np.sin(ws)
+    )
+    return ra * MJ_PARA_MM
+
+
+def evapotranspiracao_hargreaves(tmin, tmax, ra):
+    """ET0 (mm/dia) pela equação de Hargreaves, vetorizada"""
+    tmedia = (tmin + tmax) / 2
+    amplitude = np.maximum(tmax - tmin, 0.0)
+    return 0.0023 * ra * (tmedia + 17.8) * np.sqrt(amplitude)
+
+
+class MotorClima:
+    """Calcula e mantém em cache os fatores de ajuste por dia da previsão.
+
+    fator = (ET0 - chuva efetiva) / et_referencia, limitado a [fator_min, fator_max];
+    et_referencia é a demanda diária (mm) para a qual as durações cadastradas foram pensadas.
+    """
+
+    def __init__(self, fonte, latitude, et_referencia=5.0, fator_min=0.0, fator_max=1.5, chuva_efetiva=0.8):
+        self.fonte = fonte
+        self.latitude = latitude
+        self.et_referencia = et_referencia
+        self.fator_min = fator_min
+        self.fator_max = fator_max
+        self.chuva_efetiva = chuva_efetiva
+        self._cache = (None, {})
+        self._lock = threading.Lock()
+
+    def _previsao(self):
+        return self.fonte.obter() if self.fonte else None
+
+    def revisao(self):
+        previsao = self._previsao()
+        return previsao.revisao if previsao else None
+
+    def fatores(self):
+        """{data: fator} da previsão atual; recalculado só quando a revisão muda"""
+        previsao = self._previsao()
+        if previsao is None:
+            return {}
+        revisao, fatores = self._cache
+        if revisao == previsao.revisao:
+            return fatores
+        with self._lock:
+            dias_do_ano = np.array([d.timetuple().tm_yday for d in previsao.datas], dtype=float)
+            et0 = evapotranspiracao_hargreaves(
+                previsao.tmin, previsao.tmax, radiacao_extraterrestre(self.latitude, dias_do_ano)
+            )
+            demanda = np.maximum(et0 - self.chuva_efetiva * previsao.chuva, 0.0)
+            valores = np.clip(demanda / self.et_referencia, self.fator_min, self.fator_max)
+            fatores = dict(zip(previsao.datas, np.round(valores, 3).tolist()))
+            self._cache = (previsao.revisao, fatores)
+        return fatores
+
+    def fator(self, dia):
+        """Fator do dia; 1.0 (sem ajuste) fora da previsão ou sem fonte configurada"""
+        return self.fatores().get(dia, 1.0)
+
+    def tabela_duracoes(self, duracoes):
+        """Durações efetivas de vários horários em todos os dias da previsão de uma vez.
+
+        Retorna (datas, matriz) com matriz[i, j] = duracoes[i] ajustada para datas[j].
+        """
+        fatores = self.fatores()
+        datas = list(fatores)
+        matriz = np.rint(np.outer(np.asarray(duracoes, dtype=float),
+                                  np.fromiter(fatores.values(), dtype=float, count=len(datas))))
+        return datas, matriz.astype(np.int64)
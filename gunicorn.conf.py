@@ -0,0 +1,47 @@
+# Configuração do gunicorn para produção (carregada automaticamente: gunicorn app:app)
+# Workers gthread: cada worker atende GUNICORN_THREADS requisições ao mesmo tempo,
+# e o pool de conexões de cada um é dimensionado em perfil_servidor.py.
+import os
+
+from perfil_servidor import perfil_concorrencia
+
+_perfil = perfil_concorrencia()
+
+# Em produção o app fica atrás do proxy da plataforma: um salto confiável em
+# X-Forwarded-For (ver PROXY_SALTOS em app.py). Os workers herdam o ambiente.
+os.environ.setdefault('PROXY_SALTOS', '1')
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+worker_class = 'gthread'
+workers = _perfil['workers']
+threads = _perfil['threads']
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = 30
+keepalive = 5
+# Recicla workers aos poucos para conter vazamentos de memória. Com o worker de
+# tarefas embutido (TAREFAS_WORKER_EMBUTIDO=1) a reciclagem fica desligada: com
+# os dispositivos consultando o /status, mil requisições passam em minutos, e cada
+# reciclagem mataria as tarefas em execução (que só voltam à fila quando o lease
+# expira). Nesse modo, em troca, um vazamento de memória só é contido reiniciando o serviço.
+_worker_embutido = os.environ.get('TAREFAS_WORKER_EMBUTIDO') == '1'
+max_requests = 0 if _worker_embutido else 1000
+max_requests_jitter = 0 if _worker_embutido else 100
+# Sem preload: cada worker importa o app e cria o próprio pool depois do fork
+preload_app = False
+accesslog = '-'
+
+
+def when_ready(server):
+    server.log.info(
+        'Perfil: %d workers x %d threads, pool de %d conexões por worker (demanda %d, orçamento %d, reserva %d)',
+        _perfil['workers'], _perfil['threads'], _perfil['pool_size'], _perfil['demanda'],
+        _perfil['conexoes_max'], _perfil['reserva'],
+    )
+    if _perfil['excede_orcamento']:
+        server.log.warning('Os workers podem abrir %d conexões, acima do orçamento de %d (DB_CONEXOES_MAX - '
+                           'DB_CONEXOES_RESERVA). Reduza WEB_CONCURRENCY ou TAREFAS_PROCESSOS, ou aumente '
+                           'DB_CONEXOES_MAX.', _perfil['conexoes_total'], _perfil['conexoes_max'] - _perfil['reserva'])
+    elif _perfil['pool_size'] < _perfil['demanda']:
+        server.log.warning('Pool menor que o número de threads que usam o banco: requisições e tarefas vão '
+                           'esperar por conexão (veja "pool" em /metricas). Aumente DB_CONEXOES_MAX ou '
+                           'reduza WEB_CONCURRENCY.')
@@ -0,0 +1,152 @@
+"""Perfil de produção: concorrência do gunicorn e pool de conexões do Postgres.
+
+O mesmo cálculo é usado pelo gunicorn.conf.py (quantos workers/threads subir)
+e pelo app.py (tamanho do pool de cada worker), para que a soma das conexões
+de todos os workers não passe do orçamento DB_CONEXOES_MAX (quando não cabe,
+o gunicorn avisa ao subir).
+"""
+import os
+import threading
+import time
+
+from sqlalchemy import text
+from sqlalchemy.pool import QueuePool
+
+
+def perfil_concorrencia(env=os.environ):
+    """Workers, threads e pool derivados das variáveis de ambiente.
+
+    WEB_CONCURRENCY      workers do gunicorn (padrão 2)
+    GUNICORN_THREADS     threads por worker gthread (padrão 4)
+    DB_CONEXOES_MAX      conexões que este serviço pode abrir no Postgres (padrão 20)
+    DB_CONEXOES_RESERVA  parte do orçamento deixada para o worker de tarefas separado, psql etc. (padrão 4)
+
+    Com TAREFAS_WORKER_EMBUTIDO=1 cada worker web também roda o despachante de
+    tarefas: o despachante e as TAREFAS_THREADS usam o pool do worker, e cada
+    um dos TAREFAS_PROCESSOS abre a própria conexão. Se nem uma conexão por
+    worker couber no orçamento, `excede_orcamento` fica verdadeiro.
+    """
+    workers = max(1, int(env.get('WEB_CONCURRENCY', 2)))
+    threads = max(1, int(env.get('GUNICORN_THREADS', 4)))
+    conexoes_max = int(env.get('DB_CONEXOES_MAX', 20))
+    reserva = int(env.get('DB_CONEXOES_RESERVA', 4))
+    embutido = env.get('TAREFAS_WORKER_EMBUTIDO') == '1'
+    tarefas_threads = int(env.get('TAREFAS_THREADS', 4)) if embutido else 0
+    tarefas_processos = int(env.get('TAREFAS_PROCESSOS', 2)) if embutido else 0
+    # Cada thread usa no máximo uma conexão por vez; +1 para a sonda de conexão
+    # e, com o worker embutido, +1 para o despachante e uma por thread de tarefa
+    demanda = threads + 1 + (1 + tarefas_threads if embutido else 0)
+    por_worker = (conexoes_max - reserva) // workers - tarefas_processos
+    # Sem overflow: o orçamento é um teto. Abaixo de uma conexão o worker não
+    # funciona, então o pool mínimo é 1 mesmo que estoure o orçamento.
+    pool_size = max(1, min(demanda, por_worker))
+    conexoes_total = workers * (pool_size + tarefas_processos)
+    return {
+        'workers': workers,
+        'threads': threads,
+        'conexoes_max': conexoes_max,
+        'reserva': reserva,
+        'demanda': demanda,
+        'pool_size': pool_size,
+        'tarefas_processos': tarefas_processos,
+        'conexoes_total': conexoes_total,
+        'excede_orcamento': conexoes_total > conexoes_max - reserva,
+        'max_overflow': 0,
+        'pool_timeout': float(env.get('DB_POOL_TIMEOUT', 10)),
+        'pool_recycle': int(env.get('DB_POOL_RECYCLE', 1800)),
+        'intervalo_sonda': float(env.get('DB_SONDA_INTERVALO', 30)),
+    }
+
+
+class EstatisticasPool:
+    """Tempo de espera por uma conexão livre no pool (checkout)"""
+
+    # Limites superiores (s) das faixas do histograma
+    FAIXAS = (0.001, 0.01, 0.1, 1.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Zera os contadores (p. ex. entre cenários de um benchmark)"""
+        with self._lock:
+            self.checkouts = 0
+            self.esgotamentos = 0
+            self.espera_total = 0.0
+            self.espera_max = 0.0
+            self.histograma = [0] * (len(self.FAIXAS) + 1)
+
+    def registrar(self, espera, esgotou=False):
+        with self._lock:
+            self.checkouts += 1
+            self.esgotamentos += esgotou
+            self.espera_total += espera
+            self.espera_max = max(self.espera_max, espera)
+            faixa = next((i for i, limite in enumerate(self.FAIXAS) if espera < limite), len(self.FAIXAS))
+            self.histograma[faixa] += 1
+
+    def resumo(self):
+        with self._lock:
+            rotulos = [f'<{int(l * 1000)}ms' for l in self.FAIXAS] + [f'>={int(self.FAIXAS[-1] * 1000)}ms']
+            return {
+                'checkouts': self.checkouts,
+                'esgotamentos': self.esgotamentos,
+                'espera_media_ms': round(1000 * self.espera_total / self.checkouts, 3) if self.checkouts else 0.0,
+                'espera_max_ms': round(1000 * self.espera_max, 3),
+                'histograma': dict(zip(rotulos, self.histograma)),
+            }
+
+
+estatisticas_pool = EstatisticasPool()
+
+
+class QueuePoolInstrumentado(QueuePool):
+    """QueuePool que mede quanto cada checkout esperou por uma conexão"""
+
+    def _do_get(self):
+        inicio = time.perf_counter()
+        try:
+            conexao = super()._do_get()
+        except Exception:
+            estatisticas_pool.registrar(time.perf_counter() - inicio, esgotou=True)
+            raise
+        estatisticas_pool.registrar(time.perf_counter() - inicio)
+        return conexao
+
+
+def opcoes_engine(perfil):
+    """SQLALCHEMY_ENGINE_OPTIONS para Postgres.
+
+    Sem pool_pre_ping (um round trip a cada checkout): a validade das conexões
+    fica com pool_recycle e com a sonda periódica de iniciar_sonda().
+    """
+    return {
+        'poolclass': QueuePoolInstrumentado,
+        'pool_size': perfil['pool_size'],
+        'max_overflow': perfil['max_overflow'],
+        'pool_timeout': perfil['pool_timeout'],
+        'pool_recycle': perfil['pool_recycle'],
+    }
+
+
+def iniciar_sonda(engine, intervalo):
+    """Thread daemon que testa o banco a cada `intervalo` segundos.
+
+    Se a consulta falhar (banco reiniciado, failover, conexões derrubadas por
+    ociosidade), o pool é descartado e as próximas requisições abrem conexões
+    novas, em vez de cada uma descobrir o problema por conta própria.
+    """
+    parar = threading.Event()
+
+    def sondar():
+        while not parar.wait(intervalo):
+            try:
+                with engine.connect() as conexao:
+                    conexao.execute(text('SELECT 1'))
+            except Exception as e:
+                print(f"⚠️ Sonda do banco falhou, descartando o pool: {e}")
+                engine.dispose()
+
+    threading.Thread(target=sondar, name='sonda-banco', daemon=True).start()
+    return parar
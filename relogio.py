@@ -0,0 +1,36 @@
+"""Fontes de tempo para agora_br(): o relógio real e um relógio simulado."""
+from datetime import datetime, timedelta
+
+import pytz
+
+
+class RelogioSistema:
+    """Relógio de parede no fuso informado"""
+
+    def __init__(self, tz):
+        self.tz = tz
+
+    def agora(self):
+        return datetime.now(self.tz)
+
+
+class RelogioSimulado:
+    """Relógio controlado manualmente, para testes e simulações.
+
+    O avanço é feito em UTC e convertido de volta para o fuso, de modo que
+    as transições de horário de verão saem corretas.
+    """
+
+    def __init__(self, inicio):
+        if inicio.tzinfo is None:
+            raise ValueError('O relógio simulado exige um datetime com fuso horário.')
+        self.tz = inicio.tzinfo
+        self._agora = inicio
+
+    def agora(self):
+        return self._agora
+
+    def avancar(self, segundos=0, **delta):
+        em_utc = self._agora.astimezone(pytz.utc) + timedelta(seconds=segundos, **delta)
+        self._agora = em_utc.astimezone(self.tz)
+        return self._agora
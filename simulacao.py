@@ -0,0 +1,82 @@
+"""Simulação acelerada do motor de agendamento.
+
+Reproduz dias ou semanas de consultas de um dispositivo ao /status em
+segundos, trocando o relógio de agora_br() por um RelogioSimulado, e compara
+as regas disparadas com a agenda esperada (expandir_agenda).
+"""
+import random
+from datetime import datetime, timedelta
+
+from app import definir_relogio, expandir_agenda, localizar_br, verificar_horario_rega
+from relogio import RelogioSimulado
+
+
+def _minuto(momento):
+    """Chave absoluta do minuto (independente de fuso e horário de verão)"""
+    return int(momento.timestamp()) // 60
+
+
+def simular(horarios, inicio, fim, intervalo, jitter=0.0, perda=0.0, semente=None):
+    """Simula um dispositivo consultando a cada `intervalo` ± `jitter` segundos.
+
+    `perda` é a probabilidade de uma consulta não chegar ao servidor. Retorna
+    um dicionário com as regas esperadas, perdidas (nenhuma consulta disparou),
+    duplicadas (mais de uma consulta disparou a mesma rega) e espúrias
+    (disparos fora da agenda, p. ex. no horário ambíguo do fim do horário de verão).
+    """
+    if intervalo <= 0 or jitter < 0 or jitter >= intervalo:
+        raise ValueError('Use intervalo > 0 e 0 <= jitter < intervalo.')
+    if not 0 <= perda <= 1:
+        raise ValueError('Use 0 <= perda <= 1.')
+    sorteio = random.Random(semente)
+
+    esperadas = {}
+    for ocorrencia in expandir_agenda(horarios, inicio.date(), fim.date()):
+        momento = ocorrencia['inicio']
+        chave = _minuto(datetime.fromisoformat(momento))
+        if _minuto(inicio) <= chave < _minuto(fim):
+            esperadas.setdefault(chave, momento)
+    disparos = dict.fromkeys(esperadas, 0)
+    espurias = []
+    consultas = 0
+
+    relogio = RelogioSimulado(inicio)
+    anterior = definir_relogio(relogio)
+    try:
+        # A primeira consulta cai em um ponto aleatório do primeiro intervalo
+        relogio.avancar(sorteio.uniform(0, intervalo))
+        while relogio.agora() < fim:
+            if sorteio.random() >= perda:
+                consultas += 1
+                regar, _ = verificar_horario_rega(horarios)
+                if regar:
+                    chave = _minuto(relogio.agora())
+                    if chave in disparos:
+                        disparos[chave] += 1
+                    else:
+                        espurias.append(relogio.agora().isoformat())
+            relogio.avancar(intervalo + sorteio.uniform(-jitter, jitter))
+    finally:
+        definir_relogio(anterior)
+
+    perdidas = [esperadas[c] for c, n in disparos.items() if n == 0]
+    duplicadas = [esperadas[c] for c, n in disparos.items() if n > 1]
+    return {
+        'intervalo': intervalo,
+        'jitter': jitter,
+        'perda': perda,
+        'consultas': consultas,
+        'esperadas': len(esperadas),
+        'atendidas': len(esperadas) - len(perdidas),
+        'perdidas': perdidas,
+        'duplicadas': duplicadas,
+        'espurias': espurias,
+    }
+
+
+def comparar_intervalos(horarios, inicio, dias, intervalos, jitter=0.0, perda=0.0, semente=None):
+    """Roda simular() para cada intervalo de consulta sobre o mesmo período"""
+    # Mesmo horário de parede `dias` depois, mesmo atravessando o horário de verão
+    fim = localizar_br(inicio.date() + timedelta(days=dias), inicio.hour, inicio.minute)
+    return [simular(horarios, inicio, fim, intervalo, jitter=jitter, perda=perda, semente=semente)
+            for intervalo in intervalos]
@@ -0,0 +1,368 @@
+"""Execução de tarefas pesadas fora das requisições web.
+
+A rota web apenas grava a tarefa na tabela (modelo Tarefa) e retorna. Um
+worker (``flask tarefas-worker`` ou a thread embutida) reserva as tarefas
+pendentes e as executa: tarefas de E/S num pool de threads, tarefas de CPU
+num pool de processos. O progresso e o pedido de cancelamento trafegam pela
+própria tabela, de modo que qualquer processo consegue consultá-los.
+"""
+import importlib
+import inspect
+import json
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import timedelta
+
+PENDENTE = 'pendente'
+EXECUTANDO = 'executando'
+CONCLUIDA = 'concluida'
+FALHOU = 'falhou'
+CANCELADA = 'cancelada'
+ESTADOS_FINAIS = (CONCLUIDA, FALHOU, CANCELADA)
+
+
+class TarefaCancelada(Exception):
+    """Levantada dentro da tarefa quando o cancelamento foi solicitado"""
+
+
+class ContextoTarefa:
+    """Passado como primeiro argumento para a função da tarefa"""
+
+    # Intervalo mínimo entre gravações de progresso no banco
+    INTERVALO_PROGRESSO = 0.5
+
+    def __init__(self, gerenciador, tarefa_id, usuario_id):
+        self.gerenciador = gerenciador
+        self.tarefa_id = tarefa_id
+        self.usuario_id = usuario_id
+        self._ultima_gravacao = 0.0
+
+    def progresso(self, fracao, mensagem=None):
+        """Registra o progresso (0 a 1) e levanta TarefaCancelada se for o caso"""
+        agora = time.monotonic()
+        if agora - self._ultima_gravacao < self.INTERVALO_PROGRESSO and fracao < 1:
+            return
+        self._ultima_gravacao = agora
+        cancelar = self.gerenciador._gravar_progresso(self.tarefa_id, fracao, mensagem)
+        if cancelar:
+            raise TarefaCancelada()
+
+
+class _TipoTarefa:
+    def __init__(self, funcao, cpu, max_tentativas, web):
+        self.funcao = funcao
+        self.cpu = cpu
+        self.max_tentativas = max_tentativas
+        self.web = web
+
+
+class GerenciadorTarefas:
+    """Registro dos tipos de tarefa, fila no banco e pools de execução.
+
+    `agora` deve retornar datetimes ingênuos (sem fuso), como os gravados na tabela.
+    """
+
+    def __init__(self, app, db, modelo, agora, referencia, max_processos=2, max_threads=4,
+                 intervalo=1.0, lease=600, backoff=5):
+        self.app = app
+        self.db = db
+        self.modelo = modelo
+        self.agora = agora
+        # "modulo:atributo" do gerenciador, importado nos processos filhos
+        self.referencia = referencia
+        self.max_processos = max_processos
+        self.max_threads = max_threads
+        self.intervalo = intervalo
+        # Tarefa em execução sem sinal de vida por `lease` segundos volta para a fila.
+        # O despachante renova o lease das suas tarefas a cada lease/4 segundos, e
+        # progresso() também conta como sinal de vida.
+        self.lease = lease
+        self.backoff = backoff
+        self._tipos = {}
+
+    def registrar(self, tipo, cpu=False, max_tentativas=3, web=True):
+        """Decorador que registra uma função `f(contexto, **parametros)` como tipo de tarefa.
+
+        Os parâmetros aceitos e seus tipos vêm da assinatura da função: a anotação
+        ou, na falta dela, o tipo do valor padrão (ver _validar_parametros).
+        Com web=False o tipo só é enfileirado por código do servidor (CLI, agendador),
+        nunca a pedido de um usuário.
+        """
+        def decorador(funcao):
+            self._tipos[tipo] = _TipoTarefa(funcao, cpu, max_tentativas, web)
+            return funcao
+        return decorador
+
+    @property
+    def tipos(self):
+        return sorted(self._tipos)
+
+    @property
+    def tipos_web(self):
+        return sorted(t for t, d in self._tipos.items() if d.web)
+
+    # Lado web: só grava e consulta
+    def enfileirar(self, tipo, parametros=None, usuario_id=None, web=False):
+        """Grava a tarefa na fila; `web=True` para pedidos vindos de usuários"""
+        if tipo not in self._tipos or (web and not self._tipos[tipo].web):
+            tipos = self.tipos_web if web else self.tipos
+            raise ValueError(f'Tipo de tarefa desconhecido: {tipo}. Tipos: {", ".join(tipos)}')
+        parametros = parametros or {}
+        self._validar_parametros(tipo, parametros)
+        agora = self.agora()
+        tarefa = self.modelo(
+            tipo=tipo,
+            parametros=json.dumps(parametros),
+            estado=PENDENTE,
+            max_tentativas=self._tipos[tipo].max_tentativas,
+            usuario_id=usuario_id,
+            criado_em=agora,
+            atualizado_em=agora,
+        )
+        self.db.session.add(tarefa)
+        self.db.session.commit()
+        return tarefa
+
+    def _validar_parametros(self, tipo, parametros):
+        """Rejeita na hora (ValueError) o que só falharia no worker, tentativa após tentativa"""
+        # O primeiro parâmetro da função é o contexto
+        aceitos = list(inspect.signature(self._tipos[tipo].funcao).parameters.values())[1:]
+        nomes = {p.name for p in aceitos}
+        desconhecidos = sorted(set(parametros) - nomes)
+        if desconhecidos:
+            raise ValueError(f'Parâmetros desconhecidos para {tipo}: {", ".join(desconhecidos)}'
+                             f' (aceitos: {", ".join(sorted(nomes)) or "nenhum"})')
+        for p in aceitos:
+            if p.name not in parametros:
+                if p.default is p.empty:
+                    raise ValueError(f'Parâmetro obrigatório ausente para {tipo}: {p.name}')
+                continue
+            valor = parametros[p.name]
+            if p.annotation is not p.empty:
+                esperado = p.annotation
+            elif p.default is not p.empty and p.default is not None:
+                esperado = type(p.default)
+            else:
+                continue
+            if valor is None and p.default is None:
+                continue
+            # bool é subclasse de int, mas {"dias": true} não é um número de dias
+            if not isinstance(valor, esperado) or (isinstance(valor, bool) and esperado is not bool):
+                raise ValueError(f'Parâmetro {p.name} de {tipo} deve ser do tipo {esperado.__name__}')
+
+    def cancelar(self, tarefa_id):
+        """Cancela na hora se ainda está na fila; se já está rodando, sinaliza para a tarefa parar"""
+        m = self.modelo
+        agora = self.agora()
+        cancelada = self.db.session.execute(
+            self.db.update(m).where(m.id == tarefa_id, m.estado == PENDENTE)
+            .values(estado=CANCELADA, concluido_em=agora, atualizado_em=agora)
+        ).rowcount
+        if not cancelada:
+            self.db.session.execute(
+                self.db.update(m).where(m.id == tarefa_id, m.estado == EXECUTANDO).values(cancelar=True)
+            )
+        self.db.session.commit()
+
+    # Lado worker
+    def executar_worker(self, parar=None):
+        """Laço do despachante; roda até `parar` (threading.Event) ser acionado"""
+        parar = parar or threading.Event()
+        ultimo_sinal = time.monotonic()
+        threads = ThreadPoolExecutor(self.max_threads, thread_name_prefix='tarefa')
+        processos = self._criar_pool_processos()
+        # cpu: (limite, {futuro: tarefa_id})
+        em_andamento = {False: (self.max_threads, {}), True: (self.max_processos, {})}
+        try:
+            while not parar.is_set():
+                with self.app.app_context():
+                    try:
+                        if time.monotonic() - ultimo_sinal >= self.lease / 4:
+                            # Renova o lease de quem ainda está rodando, mesmo sem progresso() recente
+                            self._sinal_de_vida([i for _, futuros in em_andamento.values() for i in futuros.values()])
+                            ultimo_sinal = time.monotonic()
+                        self._recuperar_expiradas()
+                        for cpu, (limite, futuros) in em_andamento.items():
+                            for futuro in [f for f in futuros if f.done()]:
+                                tarefa_id = futuros.pop(futuro)
+                                if isinstance(futuro.exception(), BrokenProcessPool):
+                                    # O processo filho morreu (falta de memória, sinal...): a tarefa
+                                    # volta para a fila já, sem esperar o lease expirar
+                                    self._devolver(tarefa_id, 'Processo do worker encerrado inesperadamente')
+                                elif futuro.exception():
+                                    # A tarefa fica "executando" até o lease expirar e ela voltar à fila
+                                    print(f"❌ Erro no worker de tarefas: {futuro.exception()}")
+                            for tarefa_id in self._reservar(cpu, limite - len(futuros)):
+                                try:
+                                    if cpu:
+                                        futuros[processos.submit(_executar_em_processo, tarefa_id)] = tarefa_id
+                                    else:
+                                        futuros[threads.submit(self._executar_em_thread, tarefa_id)] = tarefa_id
+                                except BrokenProcessPool:
+                                    # Um pool quebrado não aceita mais nada: troca por um novo
+                                    print('⚠️ Pool de processos de tarefas quebrado, recriando')
+                                    self._devolver(tarefa_id)
+                                    processos.shutdown(wait=False, cancel_futures=True)
+                                    processos = self._criar_pool_processos()
+                    except Exception as e:
+                        # Banco reiniciando, failover etc.: o despachante não pode morrer
+                        # (embutido, é uma thread daemon e ninguém perceberia). Tenta no próximo ciclo.
+                        self.db.session.rollback()
+                        print(f"❌ Erro no despachante de tarefas: {e}")
+                parar.wait(self.intervalo)
+        finally:
+            threads.shutdown()
+            processos.shutdown()
+
+    def _criar_pool_processos(self):
+        return ProcessPoolExecutor(self.max_processos, mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=_inicializar_processo, initargs=(self.referencia,))
+
+    def iniciar_thread(self):
+        """Roda o despachante numa thread daemon do próprio processo web"""
+        parar = threading.Event()
+        threading.Thread(target=self.executar_worker, args=(parar,), name='tarefas', daemon=True).start()
+        return parar
+
+    def _reservar(self, cpu, quantidade):
+        if quantidade <= 0:
+            return []
+        tipos = [t for t, d in self._tipos.items() if d.cpu == cpu]
+        if not tipos:
+            return []
+        m = self.modelo
+        agora = self.agora()
+        candidatas = self.db.session.execute(
+            self.db.select(m.id)
+            .where(m.estado == PENDENTE, m.tipo.in_(tipos),
+                   self.db.or_(m.proxima_tentativa_em.is_(None), m.proxima_tentativa_em <= agora))
+            .order_by(m.id).limit(quantidade)
+        ).scalars().all()
+        reservadas = []
+        for tarefa_id in candidatas:
+            # Atualização condicional: só um worker consegue reservar cada tarefa
+            if self.db.session.execute(
+                self.db.update(m).where(m.id == tarefa_id, m.estado == PENDENTE)
+                .values(estado=EXECUTANDO, tentativas=m.tentativas + 1,
+                        iniciado_em=agora, atualizado_em=agora)
+            ).rowcount:
+                reservadas.append(tarefa_id)
+        self.db.session.commit()
+        return reservadas
+
+    def _sinal_de_vida(self, tarefa_ids):
+        if not tarefa_ids:
+            return
+        m = self.modelo
+        self.db.session.execute(
+            self.db.update(m).where(m.id.in_(tarefa_ids), m.estado == EXECUTANDO).values(atualizado_em=self.agora())
+        )
+        self.db.session.commit()
+
+    def _recuperar_expiradas(self):
+        """Devolve à fila (ou dá como falha) tarefas de workers que morreram"""
+        m = self.modelo
+        limite = self.agora() - timedelta(seconds=self.lease)
+        self._devolver_onde(m.atualizado_em < limite, erro='Tempo limite sem sinal de vida do worker')
+
+    def _devolver(self, tarefa_id, erro=None):
+        """Devolve à fila (ou dá como falha) uma tarefa cuja execução foi interrompida.
+
+        Sem `erro`, a tarefa nem chegou a ser executada e a tentativa não conta.
+        """
+        m = self.modelo
+        if erro is not None:
+            self._devolver_onde(m.id == tarefa_id, erro=erro)
+            return
+        self.db.session.execute(
+            self.db.update(m).where(m.id == tarefa_id, m.estado == EXECUTANDO)
+            .values(estado=PENDENTE, tentativas=m.tentativas - 1)
+        )
+        self.db.session.commit()
+
+    def _devolver_onde(self, condicao, erro):
+        m = self.modelo
+        agora = self.agora()
+        interrompidas = (m.estado == EXECUTANDO, condicao)
+        self.db.session.execute(
+            self.db.update(m).where(*interrompidas, m.tentativas >= m.max_tentativas)
+            .values(estado=FALHOU, erro=erro, concluido_em=agora)
+        )
+        self.db.session.execute(
+            self.db.update(m).where(*interrompidas).values(estado=PENDENTE, proxima_tentativa_em=agora)
+        )
+        self.db.session.commit()
+
+    def _executar_em_thread(self, tarefa_id):
+        with self.app.app_context():
+            self._executar(tarefa_id)
+
+    def _executar(self, tarefa_id):
+        m = self.modelo
+        tentativas = max_tentativas = None
+        try:
+            try:
+                tarefa = self.db.session.get(m, tarefa_id)
+                if tarefa is None:
+                    raise LookupError(f'Tarefa {tarefa_id} não encontrada')
+                tentativas, max_tentativas = tarefa.tentativas, tarefa.max_tentativas
+                contexto = ContextoTarefa(self, tarefa.id, tarefa.usuario_id)
+                tipo = self._tipos[tarefa.tipo]
+                resultado = tipo.funcao(contexto, **json.loads(tarefa.parametros or '{}'))
+                valores = dict(estado=CONCLUIDA, progresso=1.0, resultado=json.dumps(resultado))
+            except TarefaCancelada:
+                self.db.session.rollback()
+                valores = dict(estado=CANCELADA)
+            except Exception as e:
+                self.db.session.rollback()
+                print(f"❌ Erro na tarefa {tarefa_id} (tentativa {tentativas}/{max_tentativas}): {e}")
+                if tentativas is None:
+                    # Nem a tarefa foi lida: decide pelas tentativas gravadas no banco
+                    self._devolver(tarefa_id, str(e))
+                    return
+                if tentativas < max_tentativas:
+                    # Recuo exponencial: backoff, 2*backoff, 4*backoff...
+                    espera = self.backoff * 2 ** (tentativas - 1)
+                    valores = dict(estado=PENDENTE, erro=str(e),
+                                   proxima_tentativa_em=self.agora() + timedelta(seconds=espera))
+                else:
+                    valores = dict(estado=FALHOU, erro=str(e))
+            agora = self.agora()
+            if valores['estado'] != PENDENTE:
+                valores['concluido_em'] = agora
+            # Só grava se esta ainda é a tentativa em curso: se o lease expirou e a
+            # tarefa foi reservada de novo, o resultado desta execução atrasada é descartado
+            self.db.session.execute(
+                self.db.update(m).where(m.id == tarefa_id, m.estado == EXECUTANDO, m.tentativas == tentativas)
+                .values(atualizado_em=agora, **valores)
+            )
+            self.db.session.commit()
+        finally:
+            self.db.session.remove()
+
+    def _gravar_progresso(self, tarefa_id, fracao, mensagem):
+        m = self.modelo
+        valores = dict(progresso=max(0.0, min(1.0, fracao)), atualizado_em=self.agora())
+        if mensagem is not None:
+            valores['mensagem'] = mensagem[:200]
+        self.db.session.execute(self.db.update(m).where(m.id == tarefa_id).values(**valores))
+        self.db.session.commit()
+        return bool(self.db.session.execute(self.db.select(m.cancelar).where(m.id == tarefa_id)).scalar())
+
+
+# Processos filhos do pool de CPU: importam a aplicação e reutilizam o gerenciador dela
+_gerenciador_processo = None
+
+
+def _inicializar_processo(referencia):
+    global _gerenciador_processo
+    modulo, atributo = referencia.split(':')
+    _gerenciador_processo = getattr(importlib.import_module(modulo), atributo)
+
+
+def _executar_em_processo(tarefa_id):
+    with _gerenciador_processo.app.app_context():
+        _gerenciador_processo._executar(tarefa_id)
@@ -0,0 +1,8 @@
+import os
+import sys
+import tempfile
+
+# O app configura o banco ao ser importado: aponta para um SQLite descartável
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'testes.db'))
+os.environ.setdefault('TAREFAS_WORKER_EMBUTIDO', '0')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,99 @@
+import pytest
+
+import app as aplicacao
+from admissao import ControleAdmissao
+
+
+class Relogio:
+    def __init__(self):
+        self.t = 1000.0
+
+    def __call__(self):
+        return self.t
+
+
+@pytest.fixture
+def relogio():
+    return Relogio()
+
+
+def controle(relogio, **opcoes):
+    padrao = dict(taxa_dispositivo=1.0, rajada_dispositivo=2, taxa_global=100.0, rajada_global=100,
+                  max_concorrentes=10, taxa_origem=100.0, rajada_origem=100)
+    return ControleAdmissao(relogio=relogio, **dict(padrao, **opcoes))
+
+
+def test_rajada_e_retry_after(relogio):
+    c = controle(relogio, taxa_dispositivo=0.5)
+    assert c.admitir('esp') == (True, 0)
+    assert c.admitir('esp') == (True, 0)
+    # Balde vazio a 0,5 token/s: faltam 2 s para o próximo
+    assert c.admitir('esp') == (False, 2)
+    relogio.t += 1.5
+    assert c.admitir('esp') == (False, 1)
+    relogio.t += 0.5
+    assert c.admitir('esp') == (True, 0)
+    assert c.metricas()['rejeitadas_dispositivo'] == 2
+
+
+def test_dispositivos_tem_baldes_separados(relogio):
+    c = controle(relogio, rajada_dispositivo=1)
+    assert c.admitir('a')[0] and c.admitir('b')[0]
+    assert not c.admitir('a')[0]
+
+
+def test_rejeicao_global_devolve_token_do_dispositivo(relogio):
+    c = controle(relogio, taxa_global=1.0, rajada_global=1)
+    assert c.admitir('a')[0]
+    # 'b' é barrado no global: o token do balde de 'b' volta
+    assert c.admitir('b') == (False, 1)
+    relogio.t += 1
+    assert c.admitir('b')[0]
+    relogio.t += 1
+    assert c.admitir('b')[0]
+    assert c.metricas()['rejeitadas_global'] == 1
+
+
+def test_concorrencia_devolve_tokens_e_libera_vaga(relogio):
+    c = controle(relogio, max_concorrentes=1, rajada_global=2, taxa_global=0.001)
+    assert c.admitir('a')[0]
+    assert c.admitir('b') == (False, 1)
+    assert c.metricas()['rejeitadas_concorrencia'] == 1
+    c.liberar()
+    # Se a rejeição por concorrência não devolvesse o token global, o balde (2) estaria vazio
+    assert c.admitir('b')[0]
+
+
+def test_origem_limita_rotacao_de_ids(relogio):
+    c = controle(relogio, taxa_origem=1.0, rajada_origem=3)
+    admitidos = [c.admitir(f'id-{i}', '10.0.0.1')[0] for i in range(5)]
+    assert admitidos == [True, True, True, False, False]
+    # Outra origem não é afetada
+    assert c.admitir('id-9', '10.0.0.2')[0]
+    # O dispositivo barrado na origem não perde o token do próprio balde
+    relogio.t += 1
+    assert c.admitir('id-3', '10.0.0.1')[0]
+    assert c.metricas()['rejeitadas_origem'] == 2
+
+
+def test_memoria_limitada(relogio):
+    c = controle(relogio, max_dispositivos=3)
+    for i in range(10):
+        c.admitir(f'id-{i}', f'10.0.0.{i}')
+    assert c.metricas()['dispositivos_rastreados'] == 3
+    assert c.metricas()['origens_rastreadas'] == 3
+
+
+def test_rota_responde_429_com_retry_after_e_libera_vaga(monkeypatch, relogio):
+    c = controle(relogio, rajada_dispositivo=3, max_concorrentes=1)
+    monkeypatch.setattr(aplicacao, 'controle_admissao', c)
+    cliente = aplicacao.app.test_client()
+    cabecalho = {'X-Dispositivo-Id': 'esp-teste'}
+    # Com uma vaga só, as três primeiras passam porque cada requisição devolve a vaga ao terminar
+    assert [cliente.get('/status', headers=cabecalho).status_code for _ in range(3)] == [200, 200, 200]
+    resposta = cliente.get('/status', headers=cabecalho)
+    assert resposta.status_code == 429
+    assert resposta.headers['Retry-After'] == '1'
+    assert c.metricas()['rejeitadas_concorrencia'] == 0
+    # Rotas da interface web não passam pelo controle
+    assert cliente.get('/login').status_code == 200
@@ -0,0 +1,101 @@
+from datetime import date, timedelta
+from types import SimpleNamespace
+
+import pytest
+
+from app import BRASILIA_TZ, agora_br, app, localizar_br
+from relogio import RelogioSimulado
+from simulacao import simular
+
+
+def horario(id, hora, dias_semana, duracao=5):
+    return SimpleNamespace(id=id, hora=hora, duracao=duracao, dias_semana=dias_semana)
+
+
+def periodo(inicio, dias):
+    return localizar_br(inicio, 0, 0), localizar_br(inicio + timedelta(days=dias), 0, 0)
+
+
+def test_relogio_simulado_avanca_em_utc():
+    # 03/11/2018 23:30 (-03) + 1h = 04/11/2018 01:30 (-02): não existe meia-noite nesse dia
+    relogio = RelogioSimulado(localizar_br(date(2018, 11, 3), 23, 30))
+    assert relogio.avancar(hours=1).strftime('%d %H:%M %z') == '04 01:30 -0200'
+    # 16/02/2019 23:30 (-02) + 1h = 16/02/2019 23:30 de novo, agora em -03
+    relogio = RelogioSimulado(localizar_br(date(2019, 2, 16), 23, 30))
+    assert relogio.avancar(hours=1).strftime('%d %H:%M %z') == '16 23:30 -0300'
+
+
+def test_relogio_simulado_exige_fuso():
+    with pytest.raises(ValueError):
+        RelogioSimulado(localizar_br(date(2026, 10, 19), 0, 0).replace(tzinfo=None))
+
+
+def test_semana_normal():
+    horarios = [
+        horario(1, '06:00', 'Seg,Ter,Qua,Qui,Sex,Sab,Dom'),
+        horario(2, '18:15', 'Seg,Qua,Sex'),
+        horario(3, '7:5', 'Dom'),
+    ]
+    inicio, fim = periodo(date(2026, 10, 19), 7)
+    relatorio = simular(horarios, inicio, fim, intervalo=60, semente=1)
+    assert relatorio['esperadas'] == 7 + 3 + 1
+    assert relatorio['atendidas'] == relatorio['esperadas']
+    assert relatorio['perdidas'] == relatorio['duplicadas'] == relatorio['espurias'] == []
+
+
+def test_inicio_do_horario_de_verao():
+    # 04/11/2018: o relógio pulou de 00:00 para 01:00; 00:30 roda às 01:30 (-02)
+    horarios = [horario(1, '00:30', 'Dom'), horario(2, '06:00', 'Dom')]
+    inicio, fim = periodo(date(2018, 11, 3), 2)
+    relatorio = simular(horarios, inicio, fim, intervalo=60, semente=2)
+    assert relatorio['esperadas'] == 2
+    assert relatorio['perdidas'] == relatorio['duplicadas'] == relatorio['espurias'] == []
+
+
+def test_fim_do_horario_de_verao():
+    # 16/02/2019: 23:00-23:59 acontece duas vezes; a rega das 23:30 roda só na primeira
+    horarios = [horario(1, '23:30', 'Sab'), horario(2, '22:00', 'Sab')]
+    inicio, fim = periodo(date(2019, 2, 16), 1)
+    relatorio = simular(horarios, inicio, fim, intervalo=60, semente=3)
+    assert relatorio['esperadas'] == 2
+    assert relatorio['perdidas'] == relatorio['duplicadas'] == relatorio['espurias'] == []
+
+
+def test_intervalo_curto_duplica_e_longo_perde():
+    horarios = [horario(1, '06:00', 'Seg,Ter,Qua,Qui,Sex,Sab,Dom')]
+    inicio, fim = periodo(date(2026, 10, 19), 14)
+    curto = simular(horarios, inicio, fim, intervalo=30, semente=4)
+    assert curto['perdidas'] == [] and len(curto['duplicadas']) == 14
+    longo = simular(horarios, inicio, fim, intervalo=90, jitter=20, semente=4)
+    assert longo['perdidas'] and longo['duplicadas'] == []
+    assert longo['atendidas'] + len(longo['perdidas']) == 14
+
+
+def test_simulacao_restaura_relogio():
+    inicio, fim = periodo(date(2026, 10, 19), 1)
+    simular([], inicio, fim, intervalo=60)
+    assert agora_br().tzinfo.zone == BRASILIA_TZ.zone
+    assert abs(agora_br().year - date.today().year) <= 1
+
+
+@pytest.mark.parametrize('intervalo, jitter, perda', [(0, 0, 0), (30, -1, 0), (30, 30, 0), (30, 0, -0.1), (30, 0, 1.5)])
+def test_parametros_invalidos(intervalo, jitter, perda):
+    inicio, fim = periodo(date(2026, 10, 19), 1)
+    with pytest.raises(ValueError):
+        simular([], inicio, fim, intervalo=intervalo, jitter=jitter, perda=perda)
+
+
+@pytest.mark.parametrize('argumentos, opcao', [
+    (['--intervalos', '15,30', '--jitter', '15'], '--jitter'),
+    (['--jitter', '-1'], '--jitter'),
+    (['--intervalos', '0,30'], '--intervalos'),
+    (['--intervalos', 'abc'], '--intervalos'),
+    (['--perda', '1.5'], '--perda'),
+    (['--perda', '-0.1'], '--perda'),
+    (['--inicio', '19/10/2026'], '--inicio'),
+])
+def test_comando_simular_rejeita_parametros(argumentos, opcao):
+    resultado = app.test_cli_runner().invoke(args=['simular', '--dias', '1', *argumentos])
+    assert resultado.exit_code == 2
+    assert opcao in resultado.output
+    assert resultado.exception is None or isinstance(resultado.exception, SystemExit)
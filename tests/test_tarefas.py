@@ -0,0 +1,156 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from app import Tarefa, app, db
+from tarefas import CANCELADA, CONCLUIDA, EXECUTANDO, FALHOU, PENDENTE, GerenciadorTarefas
+
+
+class Relogio:
+    def __init__(self):
+        self.agora = datetime(2026, 10, 19, 8, 0)
+
+    def __call__(self):
+        return self.agora
+
+    def avancar(self, segundos):
+        self.agora += timedelta(seconds=segundos)
+
+
+@pytest.fixture
+def relogio():
+    return Relogio()
+
+
+@pytest.fixture
+def gerenciador(relogio):
+    with app.app_context():
+        db.session.query(Tarefa).delete()
+        db.session.commit()
+        yield GerenciadorTarefas(app, db, Tarefa, agora=relogio, referencia='app:gerenciador_tarefas',
+                                 lease=600, backoff=5)
+        db.session.remove()
+
+
+def ler(tarefa_id):
+    db.session.expire_all()
+    return db.session.get(Tarefa, tarefa_id)
+
+
+def test_execucao_com_sucesso(gerenciador):
+    @gerenciador.registrar('somar')
+    def somar(contexto, a=0, b=0):
+        return {'soma': a + b}
+
+    tarefa_id = gerenciador.enfileirar('somar', {'a': 2, 'b': 3}).id
+    assert gerenciador._reservar(False, 5) == [tarefa_id]
+    # Reservada uma vez, não é reservada de novo
+    assert gerenciador._reservar(False, 5) == []
+    gerenciador._executar(tarefa_id)
+    tarefa = ler(tarefa_id)
+    assert (tarefa.estado, tarefa.tentativas, tarefa.to_dict()['resultado']) == (CONCLUIDA, 1, {'soma': 5})
+
+
+def test_parametros_validados_na_fila(gerenciador):
+    @gerenciador.registrar('contar')
+    def contar(contexto, dias=30):
+        return dias
+
+    for parametros in ({'x': 1}, {'dias': 'abc'}, {'dias': True}):
+        with pytest.raises(ValueError):
+            gerenciador.enfileirar('contar', parametros)
+    with pytest.raises(ValueError):
+        gerenciador.enfileirar('inexistente')
+
+
+def test_tipo_fora_da_web(gerenciador):
+    gerenciador.registrar('interna', web=False)(lambda contexto: None)
+    with pytest.raises(ValueError):
+        gerenciador.enfileirar('interna', web=True)
+    assert gerenciador.enfileirar('interna').estado == PENDENTE
+
+
+def test_nova_tentativa_com_recuo_exponencial(gerenciador, relogio):
+    @gerenciador.registrar('falha', max_tentativas=3)
+    def falha(contexto):
+        raise RuntimeError('boom')
+
+    tarefa_id = gerenciador.enfileirar('falha').id
+    for tentativa, espera in ((1, 5), (2, 10)):
+        assert gerenciador._reservar(False, 1) == [tarefa_id]
+        gerenciador._executar(tarefa_id)
+        tarefa = ler(tarefa_id)
+        assert (tarefa.estado, tarefa.tentativas, tarefa.erro) == (PENDENTE, tentativa, 'boom')
+        assert tarefa.proxima_tentativa_em == relogio.agora + timedelta(seconds=espera)
+        # Antes do recuo acabar a tarefa não é reservada
+        relogio.avancar(espera - 1)
+        assert gerenciador._reservar(False, 1) == []
+        relogio.avancar(1)
+    assert gerenciador._reservar(False, 1) == [tarefa_id]
+    gerenciador._executar(tarefa_id)
+    assert (ler(tarefa_id).estado, ler(tarefa_id).tentativas) == (FALHOU, 3)
+
+
+def test_cancelamento_na_fila(gerenciador):
+    gerenciador.registrar('nada')(lambda contexto: None)
+    tarefa_id = gerenciador.enfileirar('nada').id
+    gerenciador.cancelar(tarefa_id)
+    assert ler(tarefa_id).estado == CANCELADA
+    assert gerenciador._reservar(False, 1) == []
+
+
+def test_cancelamento_em_execucao(gerenciador):
+    @gerenciador.registrar('longa')
+    def longa(contexto):
+        gerenciador.cancelar(contexto.tarefa_id)
+        contexto.progresso(0.5)
+        return {'nao': 'deveria chegar aqui'}
+
+    tarefa_id = gerenciador.enfileirar('longa').id
+    gerenciador._reservar(False, 1)
+    gerenciador._executar(tarefa_id)
+    tarefa = ler(tarefa_id)
+    assert (tarefa.estado, tarefa.resultado) == (CANCELADA, None)
+
+
+def test_lease_expirado_volta_para_fila(gerenciador, relogio):
+    gerenciador.registrar('nada', max_tentativas=2)(lambda contexto: None)
+    tarefa_id = gerenciador.enfileirar('nada').id
+    gerenciador._reservar(False, 1)
+    relogio.avancar(599)
+    gerenciador._recuperar_expiradas()
+    assert ler(tarefa_id).estado == EXECUTANDO
+    # O sinal de vida do despachante renova o lease
+    gerenciador._sinal_de_vida([tarefa_id])
+    relogio.avancar(599)
+    gerenciador._recuperar_expiradas()
+    assert ler(tarefa_id).estado == EXECUTANDO
+    relogio.avancar(2)
+    gerenciador._recuperar_expiradas()
+    assert ler(tarefa_id).estado == PENDENTE
+    # Na última tentativa, lease expirado é falha
+    gerenciador._reservar(False, 1)
+    relogio.avancar(601)
+    gerenciador._recuperar_expiradas()
+    tarefa = ler(tarefa_id)
+    assert (tarefa.estado, tarefa.tentativas) == (FALHOU, 2)
+
+
+def test_execucao_atrasada_nao_sobrescreve_nova_tentativa(gerenciador, relogio):
+    @gerenciador.registrar('lenta')
+    def lenta(contexto):
+        # Enquanto esta execução travava, o lease expirou e outra tentativa foi reservada
+        relogio.avancar(601)
+        gerenciador._recuperar_expiradas()
+        assert gerenciador._reservar(False, 1) == [contexto.tarefa_id]
+        return {'tentativa': 1}
+
+    tarefa_id = gerenciador.enfileirar('lenta').id
+    gerenciador._reservar(False, 1)
+    gerenciador._executar(tarefa_id)
+    tarefa = ler(tarefa_id)
+    assert (tarefa.estado, tarefa.tentativas, tarefa.resultado) == (EXECUTANDO, 2, None)
+
+
+def test_tarefa_inexistente_nao_quebra(gerenciador):
+    gerenciador._executar(999999)